@@ -0,0 +1,231 @@
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(ROOT_DIR)
+from src.data.category_encoder import CategoryEncoder
+from src.data.get_dataset import ELT
+from src.data.make_synthetic import SyntheticSales
+from src.features.build_features import FeatureEngineering
+from src.features.sales_cube import SalesCube
+from src.models.prepare_datasets import prepare_datasets
+from src.tracing import get_rss, reset_peak_rss
+from utils import load_data
+import click
+import pandas as pd
+
+
+@click.command()
+@click.option(
+    "--rows",
+    "rows_list",
+    default=[1_000_000],
+    type=int,
+    multiple=True,
+    help="Daily sales rows of a benchmark run, can be repeated.",
+)
+@click.option("--shops", default=60, type=int, help="Number of shops.")
+@click.option("--items", default=22_170, type=int, help="Number of items.")
+@click.option("--months", default=34, type=int, help="Number of months of sales.")
+@click.option(
+    "--jobs", default=1, type=int, help="Worker processes of prepare_datasets."
+)
+@click.option(
+    "--data-dir",
+    default="./data/synthetic",
+    type=click.Path(),
+    help="Directory caching the generated data between runs.",
+)
+@click.option(
+    "--output",
+    default=None,
+    type=click.Path(),
+    help="JSON file of the results, benchmarks/results/<commit>.json by default.",
+)
+def main(rows_list, shops, items, months, jobs, data_dir, output):
+    commit = _get_commit()
+    results = []
+    for rows in rows_list:
+        params = {
+            "rows": rows,
+            "shops": shops,
+            "items": items,
+            "months": months,
+            "jobs": jobs,
+        }
+        # Every size runs in a fresh process, so the peak memory of one run does not hide the next
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            records = executor.submit(run_benchmark, params, data_dir).result()
+        results.extend(records)
+        _print_records(records)
+
+    if output is None:
+        output = os.path.join(ROOT_DIR, "benchmarks", "results", f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "commit": commit,
+                "created": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Results saved to {output}")
+
+
+def run_benchmark(params, data_dir):
+    """Generates the data of the given size if needed and measures every stage of the pipeline."""
+
+    records = []
+
+    def measure(step, func, *args, **kwargs):
+        result, record = measure_step(func, *args, **kwargs)
+        records.append({**params, "step": step, **record})
+        return result
+
+    rows_dir = os.path.join(
+        data_dir,
+        "rows_{rows}_shops_{shops}_items_{items}_months_{months}".format(**params),
+    )
+    paths = {
+        name: os.path.join(rows_dir, f"{name}.csv")
+        for name in ["item_categories", "items", "shops", "sales_train", "test"]
+    }
+    if not os.path.exists(paths["test"]):
+        generator = SyntheticSales(
+            n_shops=params["shops"],
+            n_items=params["items"],
+            n_categories=84,
+            n_months=params["months"],
+        )
+        measure(
+            "make_synthetic",
+            generator.save,
+            rows_dir,
+            n_rows=params["rows"],
+            n_test_items=min(params["items"], 5_100),
+        )
+
+    output_dir = os.path.join(rows_dir, "output")
+    prepared_data_path = os.path.join(output_dir, "prepared_data.parquet")
+    encodings_path = os.path.join(output_dir, "category_encodings.json")
+    elt = ELT(
+        paths["item_categories"],
+        paths["items"],
+        paths["shops"],
+        paths["sales_train"],
+        paths["test"],
+        prepared_data_path,
+        encodings_path,
+    )
+    os.makedirs(output_dir, exist_ok=True)
+    measure("ELT.transform", elt.transform)
+
+    prepared_data = load_data(prepared_data_path)
+    sales_cube = measure("SalesCube.from_data", SalesCube.from_data, prepared_data)
+    del prepared_data
+
+    # The feature steps are measured on the last window with known labels
+    end_block_num = sales_cube.n_blocks - 2
+    processor = FeatureEngineering(
+        start_block_num=end_block_num - 12,
+        end_block_num=end_block_num,
+        category_encoder=CategoryEncoder.load(encodings_path),
+    )
+    price_data = measure(
+        "FeatureEngineering._get_price_dynamics",
+        processor._get_price_dynamics,
+        sales_cube,
+    )
+    lag_data = measure(
+        "FeatureEngineering._lag_item_count", processor._lag_item_count, sales_cube
+    )
+    data = pd.concat([price_data, lag_data], axis=1)
+    del price_data, lag_data
+    data = measure(
+        "FeatureEngineering._get_mean_features", processor._get_mean_features, data
+    )
+    data = measure(
+        "FeatureEngineering._get_other_features", processor._get_other_features, data
+    )
+    data = measure(
+        "FeatureEngineering._label_cat_features", processor._label_cat_features, data
+    )
+    del data, sales_cube
+
+    output_paths = [
+        os.path.join(output_dir, f"{name}.parquet")
+        for name in ["X_train", "y_train", "X_val", "y_val", "X_test"]
+    ]
+    measure(
+        "prepare_datasets",
+        prepare_datasets.main,
+        [prepared_data_path, *output_paths]
+        + ["--jobs", str(params["jobs"]), "--encodings-path", encodings_path],
+        standalone_mode=False,
+    )
+    return records
+
+
+def measure_step(func, *args, **kwargs):
+    """Runs func and returns its result with the wall time, CPU time and peak memory of the run."""
+
+    reset_peak_rss()
+    rss_before = _get_rss_mb("VmRSS")
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    result = func(*args, **kwargs)
+    record = {
+        "wall_s": round(time.perf_counter() - wall_start, 4),
+        "cpu_s": round(time.process_time() - cpu_start, 4),
+        "peak_rss_mb": _get_rss_mb("VmHWM"),
+    }
+    if rss_before is not None and record["peak_rss_mb"] is not None:
+        record["peak_rss_delta_mb"] = round(record["peak_rss_mb"] - rss_before, 1)
+    if isinstance(result, pd.DataFrame):
+        record["output_rows"], record["output_columns"] = result.shape
+    return result, record
+
+
+def _get_rss_mb(field):
+    rss = get_rss(field)
+    return None if rss is None else round(rss / 1024**2, 1)
+
+
+def _get_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _print_records(records):
+    print(
+        pd.DataFrame(records)[
+            ["rows", "step", "wall_s", "cpu_s", "peak_rss_mb", "peak_rss_delta_mb"]
+        ].to_string(index=False)
+    )
+
+
+if __name__ == "__main__":
+    main()
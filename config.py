@@ -3,15 +3,17 @@ items_path = "./data.dvc/items.csv"
 shops_path = "./data.dvc/shops.csv"
 sales_train_path = "./data.dvc/sales_train.csv"
 test_path = "./data.dvc/test.csv"
-prepared_data_path = "./data.dvc/prepared_data.csv"
+prepared_data_path = "./data.dvc/prepared_data.parquet"
 
-X_train_path = "./data/processed/X_train.csv"
-y_train_path = "./data/processed/y_train.csv"
-X_val_path = "./data/processed/X_val.csv"
-y_val_path = "./data/processed/y_val.csv"
-X_test_path = "./data/processed/X_test.csv"
+X_train_path = "./data/processed/X_train.parquet"
+y_train_path = "./data/processed/y_train.parquet"
+X_val_path = "./data/processed/X_val.parquet"
+y_val_path = "./data/processed/y_val.parquet"
+X_test_path = "./data/processed/X_test.parquet"
 best_grid_model_save_path = "./src/models/best_grid_model.pkl"
+hyperparam_log_path = "./src/models/hyperparam_trials.csv"
 xgb_model_save_path = "./src/models/xgb_model.pkl"
+category_encodings_path = "./models/category_encodings.json"
 
 
 # Dictionary of system duplicate store ids that need to be replaced
@@ -0,0 +1,84 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class CategoryEncoder:
+    """A dictionary of stable integer codes for the categorical features.
+    Codes are built once from the shops and item categories tables, so they are
+    the same for every window and for new rows at inference time.
+    Args:
+        categories (dict): Sorted categories of every encoded column, the code of a category is its position.
+    Attributes:
+        columns (list): Encoded columns.
+        price_cat_labels (list): Labels of the category price bins.
+        unknown_code (int): Code of missing and unseen values.
+        categories (dict): Sorted categories of every encoded column.
+    Methods:
+        fit(df_shops, df_item_cat): Builds the dictionary from the shops and item categories tables.
+        encode(column, values): Encodes the values of the column.
+        encode_value(column, value): Encodes a single value of the column.
+        save(path): Saves the dictionary to a JSON file.
+        load(path): Loads the dictionary saved by save.
+    """
+
+    columns = ["shop_name", "item_category_name", "cat_price_cat"]
+    price_cat_labels = [1, 2, 3, 4, 5, 6, 7, 8, 9]
+    unknown_code = -1
+
+    def __init__(self, categories=None):
+        """Initializes CategoryEncoder class with the provided parameters."""
+
+        self.categories = {}
+        self._codes = {}
+        for column, column_categories in (categories or {}).items():
+            self._set_categories(column, column_categories)
+
+    def _set_categories(self, column, column_categories):
+        self.categories[column] = list(column_categories)
+        self._codes[column] = {
+            category: code for code, category in enumerate(column_categories)
+        }
+
+    @classmethod
+    def fit(cls, df_shops, df_item_cat):
+        """Builds the dictionary from the shops and item categories tables."""
+
+        return cls(
+            {
+                "shop_name": sorted(df_shops["shop_name"].astype(str).unique()),
+                "item_category_name": sorted(
+                    df_item_cat["item_category_name"].astype(str).unique()
+                ),
+                "cat_price_cat": cls.price_cat_labels,
+            }
+        )
+
+    def encode(self, column, values):
+        """Encodes the values of the column, missing and unseen values get unknown_code."""
+
+        codes = pd.Series(np.asarray(values, dtype=object)).map(self._codes[column])
+        return codes.fillna(self.unknown_code).to_numpy(dtype=np.int16)
+
+    def encode_value(self, column, value):
+        """Encodes a single value of the column."""
+
+        return self._codes[column].get(value, self.unknown_code)
+
+    def save(self, path):
+        """Saves the dictionary to a JSON file."""
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.categories, f, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """Loads the dictionary saved by save."""
+
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
@@ -1,3 +1,15 @@
+import os
+import sys
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from src.data.category_encoder import CategoryEncoder
+from src.data.raw_cache import RawDataCache
+from src.data.schema import DATA_DTYPES, RAW_DTYPES
+from src.tracing import save_trace, traced, tracer
+from utils import apply_dtypes, load_data, save_data
+import numpy as np
 import pandas as pd
 import click
 
@@ -5,16 +17,94 @@ import click
 @click.command()
 @click.argument("input_paths", type=click.Path(exists=True), nargs=5)
 @click.argument("output_path", type=click.Path())
-def main(input_paths, output_path):
+@click.argument("encodings_path", type=click.Path())
+@click.option(
+    "--chunksize",
+    default=None,
+    type=int,
+    help="Read the daily sales in chunks of this many rows to bound memory.",
+)
+@click.option(
+    "--state-dir",
+    default=None,
+    type=click.Path(),
+    help="Directory keeping the monthly aggregates for incremental refreshes.",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Add the sales of a new month to the state in --state-dir instead of a full rebuild.",
+)
+@click.option(
+    "--raw-cache-dir",
+    default=None,
+    type=click.Path(),
+    help="Directory of binary snapshots of the raw files, parsed once per file content.",
+)
+@click.option(
+    "--trace",
+    default=None,
+    type=click.Path(),
+    help="Record every step and save a Chrome trace JSON file to this path.",
+)
+def main(
+    input_paths,
+    output_path,
+    encodings_path,
+    chunksize,
+    state_dir,
+    refresh,
+    raw_cache_dir,
+    trace,
+):
+    if trace is not None:
+        tracer.enable()
     item_cat_path, items_path, shops_path, sales_train_path, test_path = input_paths
 
     elt = ELT(
-        item_cat_path, items_path, shops_path, sales_train_path, test_path, output_path
+        item_cat_path,
+        items_path,
+        shops_path,
+        sales_train_path,
+        test_path,
+        output_path,
+        encodings_path,
+        chunksize=chunksize,
+        state_dir=state_dir,
+        raw_cache_dir=raw_cache_dir,
     )
-    elt.transform()
+    if refresh:
+        elt.refresh()
+    else:
+        elt.transform()
+    if trace is not None:
+        save_trace(trace)
 
 
 class ELT:
+    # Dictionary of duplicate shop ids that need to be replaced
+    replace_dict = {0: 57, 1: 58, 11: 10, 40: 39}
+    # A daily observation is an outlier if it exceeds the item mean by this many times
+    max_time_cnt = 10
+    max_time_price = 100
+    # Columns of the daily sales used by the pipeline, the date strings are not read
+    sales_columns = [
+        "date_block_num",
+        "shop_id",
+        "item_id",
+        "item_price",
+        "item_cnt_day",
+    ]
+    # Columns of the monthly rows of the prepared data, in the order they are sorted by
+    key_columns = [
+        "date_block_num",
+        "shop_id",
+        "item_category_id",
+        "item_id",
+        "item_category_name",
+        "shop_name",
+    ]
+
     def __init__(
         self,
         item_cat_path,
@@ -23,6 +113,10 @@ class ELT:
         sales_train_path,
         test_path,
         prepared_data_path,
+        category_encodings_path,
+        chunksize=None,
+        state_dir=None,
+        raw_cache_dir=None,
     ):
         self.item_cat_path = item_cat_path
         self.items_path = items_path
@@ -30,61 +124,130 @@ class ELT:
         self.sales_train_path = sales_train_path
         self.test_path = test_path
         self.prepared_data_path = prepared_data_path
+        self.category_encodings_path = category_encodings_path
+        self.chunksize = chunksize
+        self.state_dir = state_dir
+        self.raw_cache = None if raw_cache_dir is None else RawDataCache(raw_cache_dir)
 
+    @traced
     def transform(self):
+        if self.chunksize is not None or self.state_dir is not None:
+            self._transform_chunked()
+            return
         df_item_cat, df_items, df_shops, sales_train, test = self._extract_data()
-        transformed_data = self._transform_data(
-            df_item_cat, df_items, df_shops, sales_train, test
+        df_item_cat, df_items, df_shops = self._encode_categories(
+            df_item_cat, df_items, df_shops
         )
+        lookups = self._get_lookups(df_item_cat, df_items, df_shops)
+        transformed_data = self._transform_data(lookups, sales_train, test)
         filtered_data = self._remove_outliers(transformed_data)
-        grouped_data = self._get_grouped_data(filtered_data)
+        grouped_data = self._get_grouped_data(filtered_data, lookups)
         self._load_data(grouped_data, self.prepared_data_path)
 
+    def _load_raw(self, path, usecols=None):
+        # Columns are parsed directly into the dtypes of the plan, see src.data.schema,
+        # or read from the snapshot of the file with a raw cache
+        if self.raw_cache is None:
+            return load_data(path, RAW_DTYPES, usecols=usecols)
+        return self.raw_cache.load(path, RAW_DTYPES, usecols)
+
+    def _load_raw_files(self, files):
+        # Reads the (path, usecols) files concurrently, parsing and reading release the GIL
+        with ThreadPoolExecutor(max_workers=len(files)) as executor:
+            return list(executor.map(lambda file: self._load_raw(*file), files))
+
+    @traced
     def _extract_data(self):
-        df_item_cat = pd.read_csv(self.item_cat_path)
-        df_items = pd.read_csv(self.items_path)
-        df_shops = pd.read_csv(self.shops_path)
-        sales_train = pd.read_csv(self.sales_train_path)
-        test = pd.read_csv(self.test_path)
+        df_item_cat, df_items, df_shops, sales_train, test = self._load_raw_files(
+            [
+                (self.item_cat_path, None),
+                (self.items_path, None),
+                (self.shops_path, None),
+                (self.sales_train_path, self.sales_columns),
+                (self.test_path, None),
+            ]
+        )
         return df_item_cat, df_items, df_shops, sales_train, test
 
-    def _transform_data(self, df_item_cat, df_items, df_shops, sales_train, test):
+    @traced
+    def _encode_categories(self, df_item_cat, df_items, df_shops):
+        # Text names are replaced with integer codes before joining the daily data,
+        # the codes of shops and categories are saved for the feature and inference stages
+        category_encoder = CategoryEncoder.fit(df_shops, df_item_cat)
+        category_encoder.save(self.category_encodings_path)
+        df_shops["shop_name"] = category_encoder.encode(
+            "shop_name", df_shops["shop_name"]
+        )
+        df_item_cat["item_category_name"] = category_encoder.encode(
+            "item_category_name", df_item_cat["item_category_name"]
+        )
+        df_items["item_name"] = pd.factorize(df_items["item_name"])[0].astype(
+            DATA_DTYPES["item_name"]
+        )
+        return df_item_cat, df_items, df_shops
+
+    def _get_lookups(self, df_item_cat, df_items, df_shops):
+        # Dense arrays of the dimension attributes indexed by the integer ids, the
+        # daily rows get an attribute by fancy indexing instead of a merge
+        n_shops = max(df_shops["shop_id"].max(), *self.replace_dict) + 1
+        shop_remap = np.arange(n_shops, dtype=df_shops["shop_id"].dtype)
+        shop_remap[list(self.replace_dict)] = list(self.replace_dict.values())
+        return {
+            "shop_id": shop_remap,
+            "item_name": _get_lookup(df_items["item_id"], df_items["item_name"]),
+            "item_category_id": _get_lookup(
+                df_items["item_id"], df_items["item_category_id"]
+            ),
+            "item_category_name": _get_lookup(
+                df_item_cat["item_category_id"], df_item_cat["item_category_name"]
+            ),
+            "shop_name": _get_lookup(df_shops["shop_id"], df_shops["shop_name"]),
+        }
+
+    @staticmethod
+    def _add_attributes(data, lookups):
+        # Category and shop name of the monthly rows, rows of ids missing from the
+        # dimension tables are dropped as by the left merges and groupby before
+        data["item_category_id"] = _take(lookups["item_category_id"], data["item_id"])
+        data["item_category_name"] = _take(
+            lookups["item_category_name"], data["item_category_id"]
+        )
+        data["shop_name"] = _take(lookups["shop_name"], data["shop_id"])
+        known = (
+            (data["item_category_id"] >= 0)
+            & (data["item_category_name"] >= 0)
+            & (data["shop_name"] >= 0)
+        )
+        return data[known]
+
+    @traced
+    def _transform_data(self, lookups, sales_train, test):
         data = sales_train.copy()
-        replace_dict = {0: 57, 1: 58, 11: 10, 40: 39}
-        for old_value, new_value in replace_dict.items():
-            data.loc[data["shop_id"] == old_value, "shop_id"] = new_value
+        data["shop_id"] = _take(lookups["shop_id"], data["shop_id"], data["shop_id"])
         test_block_num = sales_train["date_block_num"].max() + 1
 
         test["date_block_num"] = test_block_num
+        test = apply_dtypes(test, RAW_DTYPES)
         main_features = ["date_block_num", "shop_id", "item_id"]
         data = pd.concat(
             [data, test.drop("ID", axis=1)], ignore_index=True, keys=main_features
         )
         data = data.fillna(0)
-
-        common_column = None
-        for df in [df_items, df_item_cat, df_shops]:
-            if common_column is None:
-                common_column = set(data.columns) & set(df.columns)
-            else:
-                common_column = list(set(data.columns) & set(df.columns))
-
-            data = pd.merge(data, df, on=list(common_column), how="left")
+        # Only the item name is needed before the monthly grouping, the other
+        # attributes are added to the monthly rows by _get_grouped_data
+        data["item_name"] = _take(lookups["item_name"], data["item_id"])
+        data = data[data["item_name"] >= 0]
 
         # Delete only one position with the maximum price and all positions with a negative price
         max_price_item = data.loc[data["item_price"].idxmax(), "item_name"]
         data = data[data["item_name"] != max_price_item]
         data = data.query("item_price >= 0")
-
-        data = data.drop(labels=["date"], axis=1)
-        data["item_category_name"] = data["item_category_name"].astype(str)
-        data["shop_name"] = data["shop_name"].astype(str)
-        data["item_name"] = data["item_name"].astype(str)
         return data
 
+    @traced
     def _remove_outliers(self, data):
-        max_time_cnt = 10
-        max_time_price = 100
+        max_time_cnt = self.max_time_cnt
+        max_time_price = self.max_time_price
         # At the level of daily observations, remove observations x times larger than the average observation of the sale of this product
         mean_quantity_by_item = data.groupby("item_name")["item_cnt_day"].mean()
         mean_price_by_item = data.groupby("item_name")["item_price"].mean()
@@ -100,32 +263,264 @@ class ELT:
         data = data.drop(outliers_price.index)
         return data
 
-    def _get_grouped_data(self, data):
+    @traced
+    def _get_grouped_data(self, data, lookups):
+        # The attributes are functions of the shop and the item, so they are added
+        # to the monthly rows after the grouping by the main keys
         data = data.groupby(
+            ["date_block_num", "shop_id", "item_id"], as_index=False
+        ).agg(item_price=("item_price", "mean"), item_cnt=("item_cnt_day", "sum"))
+        data = self._add_attributes(data, lookups)
+        data = data.sort_values(self.key_columns, ignore_index=True)
+        return apply_dtypes(
+            data[self.key_columns + ["item_price", "item_cnt"]], DATA_DTYPES
+        )
+
+    @traced
+    def _transform_chunked(self, state=None):
+        # Streaming variant of transform: the daily sales are read twice in chunks,
+        # the first pass collects the per item statistics for the outlier removal and
+        # the second one aggregates the filtered rows to the monthly grain as it goes,
+        # so memory depends on the number of monthly keys, not on the daily rows.
+        # With the state of a previous run the sales are added to its aggregates,
+        # sales of the months it holds already are left out
+        df_item_cat, df_items, df_shops, test = self._load_raw_files(
             [
-                "date_block_num",
-                "shop_id",
-                "item_category_id",
-                "item_id",
-                "item_category_name",
-                "shop_name",
-            ],
-            as_index=False,
-        ).agg({"item_price": ["mean"], "item_cnt_day": ["sum"]})
-        data.columns = [
-            "date_block_num",
-            "shop_id",
-            "item_category_id",
-            "item_id",
-            "item_category_name",
-            "shop_name",
-            "item_price",
-            "item_cnt",
-        ]
-        return data
+                (self.item_cat_path, None),
+                (self.items_path, None),
+                (self.shops_path, None),
+                (self.test_path, None),
+            ]
+        )
+        df_item_cat, df_items, df_shops = self._encode_categories(
+            df_item_cat, df_items, df_shops
+        )
+        lookups = self._get_lookups(df_item_cat, df_items, df_shops)
+
+        start_block_num = 0 if state is None else state["stats"]["last_block_num"] + 1
+        stats = self._get_chunk_statistics(lookups, state, start_block_num)
+        means = self._get_item_means(
+            stats, _take(lookups["item_name"], test["item_id"])
+        )
+        monthly_data = None if state is None else state["monthly_data"]
+        partials = []
+        partial_rows = 0
+        for chunk in self._iter_chunks(lookups, start_block_num):
+            partial = self._get_monthly_sums(self._filter_chunk(chunk, stats, means))
+            partials.append(partial)
+            partial_rows += len(partial)
+            # The sums of the chunks are reduced once they hold as many rows as the
+            # aggregates reduced so far, so every row is regrouped a bounded number of
+            # times and memory stays within about twice the aggregates and a chunk
+            if partial_rows >= (0 if monthly_data is None else len(monthly_data)):
+                monthly_data = self._reduce_monthly_sums(monthly_data, partials)
+                partials, partial_rows = [], 0
+        monthly_data = self._reduce_monthly_sums(monthly_data, partials)
+        if self.state_dir is not None:
+            self._save_state(stats, monthly_data)
+
+        test_rows = test.drop("ID", axis=1)
+        test_rows["date_block_num"] = stats["test_block_num"]
+        test_rows["item_price"] = 0.0
+        test_rows["item_cnt_day"] = 0.0
+        test_rows["item_name"] = _take(lookups["item_name"], test_rows["item_id"])
+        test_rows = apply_dtypes(test_rows[test_rows["item_name"] >= 0], DATA_DTYPES)
+        test_data = self._get_monthly_sums(self._filter_chunk(test_rows, stats, means))
+        grouped_data = pd.concat([monthly_data, test_data]).reset_index()
+
+        grouped_data["item_price"] = (
+            grouped_data["item_price_sum"] / grouped_data["item_price_count"]
+        )
+        grouped_data = self._add_attributes(grouped_data, lookups)
+        grouped_data = grouped_data.sort_values(self.key_columns, ignore_index=True)
+        grouped_data = apply_dtypes(
+            grouped_data.reindex(columns=self.key_columns + ["item_price", "item_cnt"]),
+            DATA_DTYPES,
+        )
+        self._load_data(grouped_data, self.prepared_data_path)
+
+    def _iter_chunks(self, lookups, start_block_num=0):
+        # Daily sales chunks of the months from start_block_num with remapped shops
+        # and the item name code
+        if self.raw_cache is None:
+            chunks = load_data(
+                self.sales_train_path,
+                RAW_DTYPES,
+                chunksize=self.chunksize,
+                usecols=self.sales_columns,
+            )
+            if self.chunksize is None:
+                chunks = [chunks]
+        else:
+            # The chunks are row ranges of the snapshot
+            data = self.raw_cache.load(
+                self.sales_train_path, RAW_DTYPES, self.sales_columns
+            )
+            chunksize = self.chunksize or max(len(data), 1)
+            chunks = (
+                data.iloc[start : start + chunksize].copy()
+                for start in range(0, len(data), chunksize)
+            )
+        n_skipped = 0
+        for chunk in chunks:
+            aggregated = chunk["date_block_num"] < start_block_num
+            if aggregated.any():
+                n_skipped += int(aggregated.sum())
+                chunk = chunk[~aggregated].copy()
+            chunk["shop_id"] = _take(
+                lookups["shop_id"], chunk["shop_id"], chunk["shop_id"]
+            )
+            chunk["item_name"] = _take(lookups["item_name"], chunk["item_id"])
+            chunk = chunk[chunk["item_name"] >= 0]
+            if len(chunk):
+                yield chunk
+        if n_skipped:
+            warnings.warn(
+                f"Skipped {n_skipped} sales rows of months before {start_block_num}, "
+                "they are aggregated in the state already"
+            )
 
+    def _get_chunk_statistics(self, lookups, state=None, start_block_num=0):
+        # Sums and counts per item name of the sales with a non-negative price,
+        # the item with the maximum price, the last month of the sales and the
+        # number of the test month
+        n_names = int(lookups["item_name"].max()) + 1
+        if state is None:
+            stats = {
+                "cnt_sum": np.zeros(n_names),
+                "price_sum": np.zeros(n_names),
+                "count": np.zeros(n_names),
+                "max_price": -np.inf,
+                "max_price_item": -1,
+                "last_block_num": -1,
+                "test_block_num": 0,
+            }
+        else:
+            # Items added since the previous run get empty statistics
+            stats = dict(state["stats"])
+            for key in ["cnt_sum", "price_sum", "count"]:
+                stats[key] = np.pad(stats[key], (0, n_names - len(stats[key])))
+        for chunk in self._iter_chunks(lookups, start_block_num):
+            stats["last_block_num"] = max(
+                stats["last_block_num"], int(chunk["date_block_num"].max())
+            )
+            stats["test_block_num"] = max(
+                stats["test_block_num"], stats["last_block_num"] + 1
+            )
+            chunk_max_price = chunk["item_price"].max()
+            if chunk_max_price > stats["max_price"]:
+                stats["max_price"] = chunk_max_price
+                stats["max_price_item"] = chunk.loc[
+                    chunk["item_price"].idxmax(), "item_name"
+                ]
+            chunk = chunk[chunk["item_price"] >= 0]
+            item_name = chunk["item_name"].to_numpy()
+            stats["cnt_sum"] += np.bincount(
+                item_name, weights=chunk["item_cnt_day"], minlength=n_names
+            )
+            stats["price_sum"] += np.bincount(
+                item_name, weights=chunk["item_price"], minlength=n_names
+            )
+            stats["count"] += np.bincount(item_name, minlength=n_names)
+        return stats
+
+    def _get_item_means(self, stats, test_item_names):
+        # The test rows count with zero price and quantity as in _transform_data
+        count = stats["count"] + np.bincount(
+            test_item_names[test_item_names >= 0], minlength=len(stats["count"])
+        )
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return {
+                "item_cnt_day": stats["cnt_sum"] / count,
+                "item_price": stats["price_sum"] / count,
+            }
+
+    def _filter_chunk(self, chunk, stats, means):
+        # Removes the maximum price item, negative prices and the outliers of _remove_outliers
+        chunk = chunk[chunk["item_name"] != stats["max_price_item"]]
+        chunk = chunk[chunk["item_price"] >= 0]
+        item_name = chunk["item_name"].to_numpy()
+        outliers_quantity = (
+            chunk["item_cnt_day"] > self.max_time_cnt * means["item_cnt_day"][item_name]
+        )
+        outliers_price = (
+            chunk["item_price"] > self.max_time_price * means["item_price"][item_name]
+        )
+        return chunk[~outliers_quantity & ~outliers_price]
+
+    def _get_monthly_sums(self, chunk):
+        # Monthly sums of the rows of a chunk
+        return chunk.groupby(["date_block_num", "shop_id", "item_id"]).agg(
+            item_price_sum=("item_price", "sum"),
+            item_price_count=("item_price", "size"),
+            item_cnt=("item_cnt_day", "sum"),
+        )
+
+    def _reduce_monthly_sums(self, monthly_data, partials):
+        # Adds the monthly sums of the chunks to the aggregates collected so far
+        if monthly_data is not None:
+            partials = [monthly_data] + partials
+        if len(partials) <= 1:
+            return partials[0] if partials else None
+        data = pd.concat(partials)
+        groups = data.groupby(level=[0, 1, 2])
+        codes = groups.ngroup().to_numpy()
+        keys = groups.size().index
+        sums = {}
+        for col in data.columns:
+            # Values are added one by one in the order of the chunks and in their
+            # dtype, the same sums as adding every chunk to the running total
+            sums[col] = np.zeros(len(keys), dtype=data[col].dtype)
+            np.add.at(sums[col], codes, data[col].to_numpy())
+        return pd.DataFrame(sums, index=keys)
+
+    @traced
+    def refresh(self):
+        """Adds the sales of the new month to the state of the previous run and rewrites the prepared data.
+        The sales file holds only the new daily rows and the test file the pairs of the next month.
+        Months aggregated before keep the outlier filtering decided at that time, sales of
+        these months are skipped with a warning, so running the refresh again with the same
+        file leaves the state and the prepared data unchanged.
+        """
+
+        self._transform_chunked(self._load_state())
+
+    def _save_state(self, stats, monthly_data):
+        os.makedirs(self.state_dir, exist_ok=True)
+        np.savez(os.path.join(self.state_dir, "item_stats.npz"), **stats)
+        save_data(
+            monthly_data.reset_index(),
+            os.path.join(self.state_dir, "monthly_data.parquet"),
+        )
+
+    def _load_state(self):
+        with np.load(os.path.join(self.state_dir, "item_stats.npz")) as f:
+            stats = {key: f[key] for key in f.files}
+        for key in ["max_price", "max_price_item", "last_block_num", "test_block_num"]:
+            stats[key] = stats[key].item()
+        monthly_data = load_data(os.path.join(self.state_dir, "monthly_data.parquet"))
+        monthly_data = monthly_data.set_index(["date_block_num", "shop_id", "item_id"])
+        return {"stats": stats, "monthly_data": monthly_data}
+
+    @traced
     def _load_data(self, data, prepared_data_path):
-        data.to_csv(prepared_data_path, index=False)
+        # The format is given by the extension of the path, see utils.save_data
+        save_data(data, prepared_data_path)
+
+
+def _get_lookup(ids, values, fill_value=-1):
+    # Dense array of the values indexed by the ids, ids without a value get fill_value
+    lookup = np.full(int(ids.max()) + 1, fill_value, dtype=values.dtype)
+    lookup[ids.to_numpy()] = values.to_numpy()
+    return lookup
+
+
+def _take(lookup, ids, fill_value=-1):
+    # Values of the lookup for the ids, ids out of its range get fill_value
+    ids = np.asarray(ids)
+    in_range = (ids >= 0) & (ids < len(lookup))
+    values = lookup[np.where(in_range, ids, 0)]
+    return np.where(in_range, values, fill_value).astype(lookup.dtype)
 
 
 if __name__ == "__main__":
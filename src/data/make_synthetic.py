@@ -0,0 +1,197 @@
+import os
+
+import click
+import numpy as np
+import pandas as pd
+
+
+@click.command()
+@click.argument("output_dir", type=click.Path())
+@click.option("--rows", default=1_000_000, type=int, help="Daily sales rows.")
+@click.option("--shops", default=60, type=int, help="Number of shops.")
+@click.option("--items", default=22_170, type=int, help="Number of items.")
+@click.option("--categories", default=84, type=int, help="Number of item categories.")
+@click.option("--months", default=34, type=int, help="Number of months of sales.")
+@click.option(
+    "--test-items", default=5_100, type=int, help="Items per shop in test.csv."
+)
+@click.option("--seed", default=0, type=int, help="Random seed.")
+def main(output_dir, rows, shops, items, categories, months, test_items, seed):
+    generator = SyntheticSales(
+        n_shops=shops,
+        n_items=items,
+        n_categories=categories,
+        n_months=months,
+        seed=seed,
+    )
+    generator.save(output_dir, n_rows=rows, n_test_items=test_items)
+
+
+class SyntheticSales:
+    """A generator of synthetic data with the schemas of the competition files.
+    Shops and items are drawn with Zipf-like popularity, every item has its own
+    base price, category and first month of sales, so the data has the skew
+    of the real sales. Daily sales are written in batches, so the number of
+    rows is not limited by memory.
+    Args:
+        n_shops (int): Number of shops.
+        n_items (int): Number of items.
+        n_categories (int): Number of item categories.
+        n_months (int): Number of months of sales.
+        seed (int): Random seed.
+    Methods:
+        get_item_categories(): Returns the item_categories.csv table.
+        get_items(): Returns the items.csv table.
+        get_shops(): Returns the shops.csv table.
+        iter_sales(n_rows, batch_size): Yields the sales_train.csv table in batches.
+        get_test(last_month_sales, n_test_items): Returns the test.csv table.
+        save(output_dir, n_rows, n_test_items): Writes all the files to the directory.
+    """
+
+    def __init__(self, n_shops, n_items, n_categories, n_months, seed=0):
+        """Initializes SyntheticSales class with the provided parameters."""
+
+        self.n_shops = n_shops
+        self.n_items = n_items
+        self.n_categories = n_categories
+        self.n_months = n_months
+        self.seed = seed
+
+        rng = np.random.default_rng(seed)
+        self.shop_weights = self._get_zipf_weights(n_shops, 0.8, rng)
+        self.item_weights = self._get_zipf_weights(n_items, 1.1, rng)
+        category_weights = self._get_zipf_weights(n_categories, 1.0, rng)
+        self.item_category = rng.choice(n_categories, size=n_items, p=category_weights)
+        self.item_price = np.round(
+            np.clip(rng.lognormal(6.0, 1.3, n_items), 1.0, 100000.0), 2
+        )
+        # Most items are on sale from the first month, the others appear later
+        self.item_first_month = np.where(
+            rng.random(n_items) < 0.4, 0, rng.integers(0, n_months, n_items)
+        )
+        self.shop_city = rng.integers(0, max(n_shops // 2, 1), n_shops)
+
+    @staticmethod
+    def _get_zipf_weights(n, exponent, rng):
+        weights = 1.0 / np.arange(1, n + 1) ** exponent
+        weights = weights[rng.permutation(n)]
+        return weights / weights.sum()
+
+    def get_item_categories(self):
+        """Returns the item_categories.csv table."""
+
+        return pd.DataFrame(
+            {
+                "item_category_name": [
+                    f"Category {i // 10} - {i}" for i in range(self.n_categories)
+                ],
+                "item_category_id": np.arange(self.n_categories),
+            }
+        )
+
+    def get_items(self):
+        """Returns the items.csv table."""
+
+        return pd.DataFrame(
+            {
+                "item_name": [f"Item {i}" for i in range(self.n_items)],
+                "item_id": np.arange(self.n_items),
+                "item_category_id": self.item_category,
+            }
+        )
+
+    def get_shops(self):
+        """Returns the shops.csv table."""
+
+        return pd.DataFrame(
+            {
+                "shop_name": [
+                    f"City{self.shop_city[i]} Shop {i}" for i in range(self.n_shops)
+                ],
+                "shop_id": np.arange(self.n_shops),
+            }
+        )
+
+    def _get_dates(self):
+        # Date strings of every (month, day) in the dd.mm.yyyy format of sales_train.csv
+        blocks = np.repeat(np.arange(self.n_months), 28)
+        days = np.tile(np.arange(1, 29), self.n_months)
+        return np.array(
+            [
+                f"{day:02d}.{block % 12 + 1:02d}.{2013 + block // 12}"
+                for block, day in zip(blocks, days)
+            ]
+        )
+
+    def iter_sales(self, n_rows, batch_size=1_000_000):
+        """Yields the sales_train.csv table in batches of batch_size rows."""
+
+        rng = np.random.default_rng(self.seed + 1)
+        dates = self._get_dates()
+        for start in range(0, n_rows, batch_size):
+            size = min(batch_size, n_rows - start)
+            item_id = rng.choice(self.n_items, size=size, p=self.item_weights)
+            shop_id = rng.choice(self.n_shops, size=size, p=self.shop_weights)
+            first_month = self.item_first_month[item_id]
+            block = first_month + (
+                rng.random(size) * (self.n_months - first_month)
+            ).astype(int)
+            day = rng.integers(0, 28, size)
+            price = self.item_price[item_id] * rng.normal(1.0, 0.05, size)
+            item_cnt_day = rng.geometric(0.7, size).astype(float)
+            # About one percent of the rows are returns
+            item_cnt_day[rng.random(size) < 0.01] = -1.0
+            yield pd.DataFrame(
+                {
+                    "date": dates[block * 28 + day],
+                    "date_block_num": block,
+                    "shop_id": shop_id,
+                    "item_id": item_id,
+                    "item_price": np.round(np.abs(price), 2),
+                    "item_cnt_day": item_cnt_day,
+                }
+            )
+
+    def get_test(self, last_month_sales, n_test_items):
+        """Returns the test.csv table, the shops and the top items of the last month."""
+
+        shops = np.sort(last_month_sales["shop_id"].unique())
+        items = (
+            last_month_sales["item_id"].value_counts().index[:n_test_items].to_numpy()
+        )
+        test = pd.DataFrame(
+            {
+                "shop_id": np.repeat(shops, len(items)),
+                "item_id": np.tile(np.sort(items), len(shops)),
+            }
+        )
+        test.insert(0, "ID", np.arange(len(test)))
+        return test
+
+    def save(self, output_dir, n_rows, n_test_items):
+        """Writes all the files to the directory."""
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.get_item_categories().to_csv(
+            os.path.join(output_dir, "item_categories.csv"), index=False
+        )
+        self.get_items().to_csv(os.path.join(output_dir, "items.csv"), index=False)
+        self.get_shops().to_csv(os.path.join(output_dir, "shops.csv"), index=False)
+
+        sales_path = os.path.join(output_dir, "sales_train.csv")
+        last_month_sales = []
+        for i, sales in enumerate(self.iter_sales(n_rows)):
+            sales.to_csv(
+                sales_path, index=False, mode="w" if i == 0 else "a", header=i == 0
+            )
+            last_month_sales.append(
+                sales.loc[
+                    sales["date_block_num"] == self.n_months - 1, ["shop_id", "item_id"]
+                ]
+            )
+        test = self.get_test(pd.concat(last_month_sales), n_test_items)
+        test.to_csv(os.path.join(output_dir, "test.csv"), index=False)
+
+
+if __name__ == "__main__":
+    main()
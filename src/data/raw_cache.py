@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+from utils import load_data, save_data
+
+# Bytes of a file hashed at a time
+MD5_CHUNK_SIZE = 1 << 24
+
+
+class RawDataCache:
+    """A local cache of typed binary snapshots of the raw input files.
+    A raw CSV file is parsed once into the dtypes of its plan and saved in the
+    .npy format of utils.save_data, whose numeric columns are memory-mapped
+    when they are read again. A snapshot is keyed by the md5 of the content of
+    the file and by the columns and dtypes read, so an edited file or a new plan
+    gets a new snapshot. The md5 of a file is computed once and kept by its size
+    and modification time, so any edit of the file is hashed again. Files can
+    be loaded from several threads.
+    Args:
+        path (str): Directory of the snapshots.
+    Attributes:
+        version (int): Version of the snapshot format, part of the keys.
+        path (str): Directory of the snapshots.
+    Methods:
+        get_md5(path): Returns the md5 of the content of a file.
+        load(path, plan, usecols): Returns the data of a raw file, from its snapshot if there is one.
+    """
+
+    version = 1
+
+    def __init__(self, path):
+        """Initializes RawDataCache class with the provided parameters."""
+
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        # Guards the read-modify-write of md5s.json between threads
+        self._lock = threading.Lock()
+
+    def get_md5(self, path):
+        """Returns the md5 of the content of a file, hashed again whenever its size or modification time changes."""
+
+        stat = os.stat(path)
+        file_key = os.path.abspath(path)
+        md5s_path = os.path.join(self.path, "md5s.json")
+        with self._lock:
+            entry = _read_json(md5s_path).get(file_key)
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+
+        digest = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(MD5_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        # The md5s of the other files may have been written since they were read
+        with self._lock:
+            md5s = _read_json(md5s_path)
+            md5s[file_key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+            _write_json(md5s_path, md5s)
+        return digest.hexdigest()
+
+    def load(self, path, plan=None, usecols=None):
+        """Returns the data of a raw file read with the plan and usecols of utils.load_data.
+        The file is parsed and its snapshot written on the first call, the next
+        calls read the snapshot.
+        """
+
+        key = hashlib.md5(
+            json.dumps(
+                [self.version, self.get_md5(path), plan, usecols], sort_keys=True
+            ).encode()
+        ).hexdigest()
+        name = os.path.splitext(os.path.basename(path))[0]
+        snapshot_path = os.path.join(self.path, f"{name}-{key}.npy")
+        if os.path.exists(snapshot_path):
+            return load_data(snapshot_path)
+
+        data = load_data(path, plan, usecols=usecols)
+        # Snapshots are written under a temporary name and renamed, so that
+        # concurrent runs never read a partial snapshot
+        tmp_path = f"{snapshot_path}.{uuid.uuid4().hex}.tmp.npy"
+        save_data(data, tmp_path)
+        try:
+            os.replace(tmp_path, snapshot_path)
+        except OSError:
+            # Another run has written the same snapshot
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return data
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
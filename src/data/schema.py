@@ -0,0 +1,85 @@
+import re
+
+# Dtype plans of the pipeline columns. A plan maps a regular expression matching
+# the whole column name to the dtype of the column, names that are not strings,
+# such as the month numbers of the lags, are matched as their str.
+# The plans are applied when the data is read and when a column is created, so
+# no full-width int64/float64 frame is built and downcast afterwards.
+
+# Daily sales and dimension tables as read from the csv files. Ids that do not
+# fit their dtype are downcast with a warning by utils.apply_dtypes, the dtypes
+# keep a headroom far above the sizes of the competition data
+RAW_DTYPES = {
+    "date_block_num": "int16",
+    "shop_id": "int16",
+    "item_id": "int32",
+    "item_category_id": "int16",
+    "ID": "int32",
+    "item_price": "float32",
+    "item_cnt_day": "float32",
+}
+
+# Prepared data, where the names are the integer codes given by ELT
+DATA_DTYPES = {
+    **RAW_DTYPES,
+    "item_category_name": "int16",
+    "shop_name": "int16",
+    "item_name": "int32",
+    "item_cnt": "float32",
+}
+
+# Features of a window while FeatureEngineering computes them
+FEATURE_DTYPES = {
+    **DATA_DTYPES,
+    r"\d+": "float32",
+    r"Price \d+": "float32",
+    r"shop_item_cnt_mean": "float32",
+    r"shop_item_category_cnt_mean_[xy]": "float32",
+    r"sity_item_id_cnt_mean": "float32",
+    r"sity_category_id_cnt_mean": "float32",
+    r"sity_item_category": "float32",
+    r"shop_item_cat_cnt_cat": "float32",
+    r"sity_item_cat_cnt_cat": "float32",
+    r"cat_price_cat": "int16",
+    r"year": "int16",
+    r"season": "int8",
+    r"month": "int8",
+    r"rolling_(mean|std|slope) \d+": "float32",
+    r"months_since_(first|last)_sale": "int16",
+}
+
+# Rounded features of the datasets returned by get_data, the lags and the means
+# are clipped item counts and the prices are whole roubles. Features planned as
+# floats, the rolling statistics, are not rounded
+DATASET_DTYPES = {
+    **FEATURE_DTYPES,
+    r"lag \d+": "int8",
+    r"Price \d+": "int32",
+    r"shop_item_cnt_mean": "int8",
+    r"shop_item_category_cnt_mean_[xy]": "int8",
+    r"sity_item_id_cnt_mean": "int8",
+    r"sity_category_id_cnt_mean": "int8",
+    r"sity_item_category": "int8",
+    r"shop_item_cat_cnt_cat": "int8",
+    r"sity_item_cat_cnt_cat": "int8",
+    r"cat_price_cat": "int8",
+}
+
+# Labels of the datasets returned by get_data
+LABEL_DTYPE = "float32"
+
+
+def get_dtype(column, plan):
+    """Returns the dtype of the column in the plan, None if the plan does not cover it."""
+
+    for pattern, dtype in plan.items():
+        if re.fullmatch(pattern, str(column)):
+            return dtype
+    return None
+
+
+def get_dtypes(columns, plan):
+    """Returns the dtypes of the columns covered by the plan, as the dtype argument of read_csv."""
+
+    dtypes = {column: get_dtype(column, plan) for column in columns}
+    return {column: dtype for column, dtype in dtypes.items() if dtype is not None}
@@ -0,0 +1,160 @@
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils import save_data
+
+# Formats that save_split appends window by window
+STREAMED_FORMATS = (".parquet", ".csv")
+
+
+class ShardedDataset:
+    """An append-only dataset of the windows, one features and one labels shard per window.
+    Windows are written as soon as they are generated and a manifest records the
+    windows of the train, validation and test splits. A split is read or saved
+    shard by shard, so memory holds about one window and the time is linear in
+    the size of the split.
+    Args:
+        path (str): Directory of the shards and the manifest.
+    Attributes:
+        path (str): Directory of the shards and the manifest.
+    Methods:
+        write_window(end_block_num, X, y): Writes the shards of a window.
+        read_window(end_block_num): Reads the shards of a window, None if it is not written.
+        write_manifest(splits): Writes the windows of every split.
+        read_manifest(): Reads the windows of every split.
+        iter_split(split): Yields the features and labels of the windows of a split.
+        load_split(split): Returns the features and labels of a split.
+        save_split(split, X_path, y_path): Saves a split to data files shard by shard.
+    """
+
+    def __init__(self, path):
+        """Initializes ShardedDataset class with the provided parameters."""
+
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _get_window_paths(self, end_block_num):
+        return (
+            os.path.join(self.path, f"X_{end_block_num}.parquet"),
+            os.path.join(self.path, f"y_{end_block_num}.parquet"),
+        )
+
+    def write_window(self, end_block_num, X, y):
+        """Writes the shards of a window."""
+
+        X_path, y_path = self._get_window_paths(end_block_num)
+        save_data(X, X_path)
+        save_data(y, y_path)
+
+    def read_window(self, end_block_num):
+        """Reads the shards of a window, None if it is not written.
+        Labels are named by end_block_num as the labels of a generated window.
+        """
+
+        X_path, y_path = self._get_window_paths(end_block_num)
+        if not (os.path.exists(X_path) and os.path.exists(y_path)):
+            return None
+        y = pd.read_parquet(y_path).iloc[:, 0].rename(end_block_num)
+        return pd.read_parquet(X_path), y
+
+    def write_manifest(self, splits):
+        """Writes the windows of every split, a dict of split names and lists of end_block_num."""
+
+        manifest = {
+            "splits": {
+                split: [int(end_block_num) for end_block_num in end_block_nums]
+                for split, end_block_nums in splits.items()
+            }
+        }
+        with open(os.path.join(self.path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def read_manifest(self):
+        """Reads the windows of every split."""
+
+        with open(os.path.join(self.path, "manifest.json")) as f:
+            return json.load(f)["splits"]
+
+    def iter_split(self, split):
+        """Yields the features and labels of the windows of a split in the order of the manifest."""
+
+        for end_block_num in self.read_manifest()[split]:
+            window = self.read_window(end_block_num)
+            if window is None:
+                raise FileNotFoundError(
+                    f"Window {end_block_num} of the {split} split is not in {self.path}"
+                )
+            yield window
+
+    def load_split(self, split):
+        """Returns the features and labels of a split, concatenated once."""
+
+        windows = list(self.iter_split(split))
+        X = pd.concat([X for X, _ in windows], ignore_index=True)
+        y = pd.concat([y for _, y in windows], ignore_index=True).rename(None)
+        return X, y
+
+    def save_split(self, split, X_path, y_path=None):
+        """Saves a split to data files shard by shard, the format is given by the extension.
+        Parquet and CSV files are appended window by window, other formats of
+        utils.save_data are written from the concatenated split. The labels of
+        the split are saved only with y_path.
+        """
+
+        if not X_path.endswith(STREAMED_FORMATS) or (
+            y_path is not None and not y_path.endswith(STREAMED_FORMATS)
+        ):
+            X, y = self.load_split(split)
+            save_data(X, X_path)
+            if y_path is not None:
+                save_data(y, y_path)
+            return
+
+        X_writer = _DataWriter(X_path)
+        y_writer = None if y_path is None else _DataWriter(y_path)
+        try:
+            for X, y in self.iter_split(split):
+                X_writer.write(X)
+                if y_writer is not None:
+                    # Labels of several windows have no common name, as after pd.concat
+                    y_writer.write(y.rename(None).to_frame())
+        finally:
+            X_writer.close()
+            if y_writer is not None:
+                y_writer.close()
+
+
+class _DataWriter:
+    # Appends frames to a parquet file as row groups or to a CSV file as lines
+
+    def __init__(self, path):
+        self.path = path
+        self._writer = None
+        self._header = True
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, data):
+        data = data.set_axis([str(col) for col in data.columns], axis=1)
+        if self.path.endswith(".csv"):
+            data.to_csv(
+                self.path,
+                index=False,
+                mode="w" if self._header else "a",
+                header=self._header,
+            )
+            self._header = False
+            return
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, table.schema)
+        self._writer.write_table(table.cast(self._writer.schema))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
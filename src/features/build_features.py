@@ -1,7 +1,12 @@
-# from sklearn.preprocessing import LabelEncoder
+# from src.data.category_encoder import CategoryEncoder
 import numpy as np
 import pandas as pd
 
+from src.data.schema import FEATURE_DTYPES, get_dtype
+from src.features.group_aggregator import GroupAggregator
+from src.features.sales_cube import SalesCube
+from src.tracing import traced
+
 # import sys
 # sys.path.append('D:/Innowise/DS project')
 # import config
@@ -14,154 +19,191 @@ class FeatureEngineering:
     Args:
         start_block_num (int): The starting block number for feature generation.
         end_block_num (int): The ending block number for feature generation.
-        label_encoder (object): The label encoder object for encoding categorical features.
+        category_encoder (CategoryEncoder): The dictionary of stable codes of categorical features.
         clip_threshold (int): The threshold for clipping item count.
+        cache (FeatureCache): Cache of the feature blocks, None to compute every block.
+        rolling_stats (bool): Whether to add the rolling statistics of the item count.
+        use_rollup (bool): Whether to read the group means from the rollup cube of the sales cube.
     Attributes:
+        price_bins (list): Bins of the mean category price.
+        price_labels (list): Labels of the price bins.
+        rolling_horizons (list): Months before the label month of the rolling statistics.
+        feature_versions (dict): Versions of the code of the feature families.
         start_block_num (int): The starting block number for feature generation.
         end_block_num (int): The ending block number for feature generation.
-        label_encoder (object): The label encoder object for encoding categorical features.
+        category_encoder (CategoryEncoder): The dictionary of stable codes of categorical features.
         clip_threshold (int): The threshold for clipping item count.
+        cache (FeatureCache): Cache of the feature blocks, None to compute every block.
+        rolling_stats (bool): Whether to add the rolling statistics of the item count.
+        use_rollup (bool): Whether to read the group means from the rollup cube of the sales cube.
     Methods:
-        _get_price_dynamics(data): Generates price dynamics features based on the part of the dataset.
-        _lag_item_count(data): Generates lagged item count features based on the part of the dataset.
+        _set_feature(data, name, values): Adds a feature column in the dtype of the plan.
+        _get_group_means(aggregator, keys, values, skip_zeros): Returns the group means of the values for every row.
+        _get_category_means(data): Returns the mean last month price of every item category.
+        _get_price_categories(category_means): Returns the price bin of every item category.
+        _get_price_dynamics(cube): Generates price dynamics features based on the part of the dataset.
+        _lag_item_count(cube): Generates lagged item count features based on the part of the dataset.
         _get_mean_features(data): Generates mean features based on the part of the dataset.
         _get_other_features(data): Generates other features based on the part of the dataset.
         _label_cat_features(data): Labels categorical features based on the part of the dataset.
+        _get_rolling_stats(cube): Generates the rolling statistics of the item count before the label month.
+        _get_cached_features(cube): Combines the feature blocks, taking the ones with unchanged inputs from the cache.
         get_features(data): Combines all feature generation methods and returns the final part of the dataset with features.
+            The data can be the prepared dataset or a SalesCube built from it once and shared by all windows.
     """
 
-    def __init__(self, start_block_num, end_block_num, label_encoder):
+    # Bins of the mean category price and their labels in cat_price_cat
+    price_bins = [0, 100, 500, 1000, 2000, 3000, 4000, 5000, 10000, 23000]
+    price_labels = [1, 2, 3, 4, 5, 6, 7, 8, 9]
+    rolling_horizons = [3, 6, 12]
+    # The version of a family is part of the keys of its cached blocks,
+    # it is increased with every change of the features the family generates
+    feature_versions = {
+        "price_dynamics": 1,
+        "lag_item_count": 1,
+        "mean_features": 1,
+        "other_features": 1,
+        "rolling_stats": 1,
+    }
+
+    def __init__(
+        self,
+        start_block_num,
+        end_block_num,
+        category_encoder,
+        clip_threshold=20,
+        cache=None,
+        rolling_stats=False,
+        use_rollup=True,
+    ):
         """Initializes FeatureEngineering class with the provided parameters."""
 
         self.start_block_num = start_block_num
         self.end_block_num = end_block_num
-        self.label_encoder = label_encoder
+        self.category_encoder = category_encoder
+        self.clip_threshold = clip_threshold
+        self.cache = cache
+        self.rolling_stats = rolling_stats
+        self.use_rollup = use_rollup
+        # Rollup cube of the sales cube of the current get_features call
+        self._rollup = None
+
+    def _set_feature(self, data, name, values):
+        """Adds a feature column in its dtype of src.data.schema.FEATURE_DTYPES."""
+
+        dtype = get_dtype(name, FEATURE_DTYPES)
+        if np.ndim(values) == 0:
+            data[name] = np.full(len(data), values, dtype=dtype)
+        else:
+            data[name] = np.asarray(values).astype(dtype, copy=False)
+
+    def _get_group_means(self, aggregator, keys, values, skip_zeros=False):
+        """Returns the group means of the values for every row, see GroupAggregator.get_group_means.
+        The values are the lags of the window, with a rollup cube their group sums
+        are sliced from it instead of being aggregated again for every window.
+        """
+
+        if self._rollup is None:
+            return aggregator.get_group_means(keys, values, skip_zeros)
+        category_bins = None
+        if "cat_price_cat" in keys:
+            category_bins = (
+                aggregator.data[["item_category_id", "cat_price_cat"]]
+                .drop_duplicates("item_category_id")
+                .set_index("item_category_id")["cat_price_cat"]
+            )
+        return self._rollup.get_group_means(
+            keys,
+            self.start_block_num,
+            self.end_block_num,
+            skip_zeros,
+            category_bins=category_bins,
+        )
+
+    def _get_category_means(self, data):
+        """Returns the mean last month price of every item category."""
+
+        return data.groupby("item_category_id")["Price 1"].mean()
+
+    def _get_price_categories(self, category_means):
+        """Returns the price bin of every item category from its mean price."""
+
+        return pd.cut(category_means, bins=self.price_bins, labels=self.price_labels)
 
-    def _get_price_dynamics(self, data):
+    @traced
+    def _get_price_dynamics(self, cube):
         """Generates price dynamics features based on the part of the dataset."""
 
-        df_pivot = data.pivot_table(
-            index=[
-                "shop_id",
-                "item_category_id",
-                "item_id",
-                "item_category_name",
-                "shop_name",
-            ],
-            columns="date_block_num",
-            values="item_price",
-            aggfunc="mean",
-        ).fillna(0.0)
-        df_pivot = df_pivot.reset_index()
-        str_columns = [col for col in df_pivot.columns if isinstance(col, str)]
-        int_columns = [col for col in df_pivot.columns if isinstance(col, int)]
-        df_pivot = df_pivot.groupby(str_columns)[int_columns].sum().reset_index()
-        price_dynamics = df_pivot.loc[:, self.start_block_num : self.end_block_num - 1]
+        price_dynamics = cube.get_item_price(
+            self.start_block_num, self.end_block_num - 1
+        )
         rename_dict = {
             col: f"Price {i + 1}"
             for i, col in enumerate([col for col in price_dynamics.columns][::-1])
         }
         price_dynamics.rename(columns=rename_dict, inplace=True)
-        data = pd.concat([df_pivot[str_columns], price_dynamics], axis=1)
+        data = pd.concat([cube.index, price_dynamics], axis=1)
         return data
 
-    def _lag_item_count(self, data):
+    @traced
+    def _lag_item_count(self, cube):
         """Generates lagged item count features based on the part of the dataset."""
 
-        data["item_cnt"] = data["item_cnt"].clip(0, 20)
-        df_pivot = data.pivot_table(
-            index=[
-                "shop_id",
-                "item_category_id",
-                "item_id",
-                "item_category_name",
-                "shop_name",
-            ],
-            columns="date_block_num",
-            values="item_cnt",
-            aggfunc="sum",
-        ).fillna(0.0)
-        df_pivot = df_pivot.reset_index()
-        str_columns = [col for col in df_pivot.columns if isinstance(col, str)]
-        int_columns = [col for col in df_pivot.columns if isinstance(col, int)]
-
-        df_pivot = df_pivot.groupby(str_columns)[int_columns].sum().reset_index()
-        selected_cols = df_pivot.loc[:, self.start_block_num : self.end_block_num]
-        data = pd.concat([df_pivot[str_columns], selected_cols], axis=1)
+        data = cube.get_item_cnt(self.start_block_num, self.end_block_num)
+        data = data.clip(0, self.clip_threshold)
         return data
 
+    @traced
     def _get_mean_features(self, data):
         """Generates mean features based on the part of the dataset."""
         int_columns = [col for col in data.columns if isinstance(col, int)]
         y_col_name = max(int_columns)
         x_col_names = int_columns.copy()
         x_col_names.remove(y_col_name)
-        df_filtered = data.copy()
-        df_filtered[x_col_names] = df_filtered[x_col_names].replace(0, np.nan)
-
-        group_means_shop_item = (
-            df_filtered.groupby(["shop_id", "item_id"])[x_col_names]
-            .mean()
-            .mean(axis=1)
-            .reset_index(name="shop_item_cnt_mean")
-        )
-        group_means_shop_item_category = (
-            df_filtered.groupby(["shop_id", "item_category_name"])[x_col_names]
-            .mean()
-            .mean(axis=1)
-            .reset_index(name="shop_item_category_id_cnt_mean")
-        )
-        group_means_sity_item_id = (
-            df_filtered.groupby(["shop_name", "item_id"])[x_col_names]
-            .mean()
-            .mean(axis=1)
-            .reset_index(name="sity_item_id_cnt_mean")
-        )
-        group_means_shop_item_category = (
-            df_filtered.groupby(["shop_id", "item_category_name"])[x_col_names]
-            .mean()
-            .mean(axis=1)
-            .reset_index(name="shop_item_category_cnt_mean")
-        )
-        group_means_sity_category_id_cnt_mean = (
-            df_filtered.groupby(["shop_name", "item_category_id"])[x_col_names]
-            .mean()
-            .mean(axis=1)
-            .reset_index(name="sity_category_id_cnt_mean")
-        )
-        group_means_sity_item_category = (
-            df_filtered.groupby(["shop_name", "item_category_name"])[x_col_names]
-            .mean()
-            .mean(axis=1)
-            .reset_index(name="sity_item_category")
-        )
-
-        data = data.merge(group_means_shop_item, on=["shop_id", "item_id"], how="left")
-        data = data.merge(
-            group_means_shop_item_category,
-            on=["shop_id", "item_category_name"],
-            how="left",
-        )
-        data = data.merge(
-            group_means_sity_item_id, on=["shop_name", "item_id"], how="left"
-        )
-        data = data.merge(
-            group_means_shop_item_category,
-            on=["shop_id", "item_category_name"],
-            how="left",
-        )
-        data = data.merge(
-            group_means_sity_category_id_cnt_mean,
-            on=["shop_name", "item_category_id"],
-            how="left",
-        )
-        data = data.merge(
-            group_means_sity_item_category,
-            on=["shop_name", "item_category_name"],
-            how="left",
+        lags = data[x_col_names].to_numpy()
+        aggregator = GroupAggregator(data)
+
+        # Zero sales are skipped in the means as if they were missing
+        shop_item_category_cnt_mean = self._get_group_means(
+            aggregator, ["shop_id", "item_category_name"], lags, skip_zeros=True
+        )
+        self._set_feature(
+            data,
+            "shop_item_cnt_mean",
+            self._get_group_means(
+                aggregator, ["shop_id", "item_id"], lags, skip_zeros=True
+            ),
+        )
+        self._set_feature(
+            data, "shop_item_category_cnt_mean_x", shop_item_category_cnt_mean
+        )
+        self._set_feature(
+            data,
+            "sity_item_id_cnt_mean",
+            self._get_group_means(
+                aggregator, ["shop_name", "item_id"], lags, skip_zeros=True
+            ),
+        )
+        self._set_feature(
+            data, "shop_item_category_cnt_mean_y", shop_item_category_cnt_mean
+        )
+        self._set_feature(
+            data,
+            "sity_category_id_cnt_mean",
+            self._get_group_means(
+                aggregator, ["shop_name", "item_category_id"], lags, skip_zeros=True
+            ),
+        )
+        self._set_feature(
+            data,
+            "sity_item_category",
+            self._get_group_means(
+                aggregator, ["shop_name", "item_category_name"], lags, skip_zeros=True
+            ),
         )
         return data
 
+    @traced
     def _get_other_features(self, data):
         """Generates other features based on the part of the dataset."""
 
@@ -171,73 +213,154 @@ class FeatureEngineering:
         x_col_names = int_columns.copy()
         x_col_names.remove(y_col_name)
 
-        category_means = (
-            data.groupby("item_category_id")["Price 1"].mean().reset_index()
-        )
-        bins = [0, 100, 500, 1000, 2000, 3000, 4000, 5000, 10000, 23000]
-        category_means["cat_price_cat"] = pd.cut(
-            category_means["Price 1"], bins=bins, labels=[1, 2, 3, 4, 5, 6, 7, 8, 9]
-        )
-        data = pd.merge(
-            data,
-            category_means.drop(labels=["Price 1"], axis=1),
-            on=["item_category_id"],
-            how="left",
-        )
+        cat_price_cat = self._get_price_categories(self._get_category_means(data))
+        data["cat_price_cat"] = cat_price_cat.reindex(data["item_category_id"]).values
 
-        group_means_shop_item_cat_cnt_cat = (
-            data.groupby(["shop_id", "cat_price_cat"])[x_col_names]
-            .mean()
-            .mean(axis=1)
-            .reset_index(name="shop_item_cat_cnt_cat")
-        )
-        data = data.merge(
-            group_means_shop_item_cat_cnt_cat,
-            on=["shop_id", "cat_price_cat"],
-            how="left",
-        )
-        group_means_sity_item_cat_cnt_cat = (
-            data.groupby(["shop_name", "cat_price_cat"])[x_col_names]
-            .mean()
-            .mean(axis=1)
-            .reset_index(name="sity_item_cat_cnt_cat")
+        lags = data[x_col_names].to_numpy()
+        aggregator = GroupAggregator(data)
+        self._set_feature(
+            data,
+            "shop_item_cat_cnt_cat",
+            self._get_group_means(aggregator, ["shop_id", "cat_price_cat"], lags),
         )
-        data = data.merge(
-            group_means_sity_item_cat_cnt_cat,
-            on=["shop_name", "cat_price_cat"],
-            how="left",
+        self._set_feature(
+            data,
+            "sity_item_cat_cnt_cat",
+            self._get_group_means(aggregator, ["shop_name", "cat_price_cat"], lags),
         )
 
-        data["year"] = (y_col_name // 12) + 2013
-        data["season"] = y_col_name % 4
-        data["month"] = y_col_name % 12
+        self._set_feature(data, "year", (y_col_name // 12) + 2013)
+        self._set_feature(data, "season", y_col_name % 4)
+        self._set_feature(data, "month", y_col_name % 12)
         return data
 
+    @traced
     def _label_cat_features(self, data):
-        """Labels categorical features based on the part of the dataset."""
+        """Labels categorical features based on the part of the dataset.
+        Shop and category names are already coded by ELT, so only the price bins are encoded here.
+        """
 
-        data["shop_name"] = self.label_encoder.fit_transform(data["shop_name"])
-        data["item_category_name"] = self.label_encoder.fit_transform(
-            data["item_category_name"]
+        self._set_feature(
+            data,
+            "cat_price_cat",
+            self.category_encoder.encode("cat_price_cat", data["cat_price_cat"]),
         )
-        data["cat_price_cat"] = self.label_encoder.fit_transform(data["cat_price_cat"])
         data = data.fillna(0.0)
         return data
 
+    @traced
+    def _get_rolling_stats(self, cube):
+        """Generates the rolling statistics of the item count before the label month.
+        They are differences of the prefix sums of the cube, built once and shared by the windows.
+        """
+
+        features = cube.get_rolling_stats(self.clip_threshold).get_features(
+            self.end_block_num, self.rolling_horizons
+        )
+        data = pd.DataFrame(index=features.index)
+        for col in features.columns:
+            self._set_feature(data, col, features[col].to_numpy())
+        return data
+
+    @traced
     def get_features(self, data):
         """Combines all feature generation methods and returns the final part of the dataset with features."""
 
-        lag_price_features = self._get_price_dynamics(data)
-        lag_item_data = self._lag_item_count(data)
-        str_columns = [col for col in lag_item_data.columns if isinstance(col, str)]
-        full_data = lag_price_features.merge(lag_item_data, on=str_columns, how="left")
+        cube = data if isinstance(data, SalesCube) else SalesCube.from_data(data)
+        self._rollup = cube.get_rollup(self.clip_threshold) if self.use_rollup else None
+        if self.cache is not None:
+            return self._get_cached_features(cube)
+        lag_price_features = self._get_price_dynamics(cube)
+        lag_item_data = self._lag_item_count(cube)
+        full_data = pd.concat([lag_price_features, lag_item_data], axis=1)
         full_data = self._get_mean_features(full_data)
         full_data = self._get_other_features(full_data)
         full_data = self._label_cat_features(full_data)
+        if self.rolling_stats:
+            full_data = pd.concat([full_data, self._get_rolling_stats(cube)], axis=1)
         return full_data
 
+    def _get_cached_features(self, cube):
+        """Combines the feature blocks, taking the ones with unchanged inputs from the cache.
+        A block depends on the cube rows, the months of the window its family reads,
+        the version of the family, its parameters and the blocks it is computed from.
+        """
+
+        cache = self.cache
+        versions = self.feature_versions
+        window = [self.start_block_num, self.end_block_num]
+        index_key = cache.get_key(cube.index)
+        price_key = cache.get_key(
+            versions["price_dynamics"],
+            index_key,
+            window,
+            cube.item_price[:, self.start_block_num : self.end_block_num],
+        )
+        lag_key = cache.get_key(
+            versions["lag_item_count"],
+            index_key,
+            window,
+            cube.item_cnt[:, self.start_block_num : self.end_block_num + 1],
+            self.clip_threshold,
+        )
+        mean_key = cache.get_key(versions["mean_features"], lag_key)
+        other_key = cache.get_key(
+            versions["other_features"],
+            price_key,
+            lag_key,
+            self.price_bins,
+            self.price_labels,
+            self.category_encoder.categories,
+        )
+
+        blocks = []
+        for family, key, get_block in [
+            ("price_dynamics", price_key, lambda: self._get_price_dynamics(cube)),
+            ("lag_item_count", lag_key, lambda: self._lag_item_count(cube)),
+        ]:
+            block = cache.get(family, key)
+            if block is None:
+                block = get_block()
+                cache.put(family, key, block)
+            blocks.append(block)
+        full_data = pd.concat(blocks, axis=1)
+
+        # Families computed from the previous blocks are cached as the columns they add
+        for family, key, add_features in [
+            ("mean_features", mean_key, self._get_mean_features),
+            (
+                "other_features",
+                other_key,
+                lambda data: self._label_cat_features(self._get_other_features(data)),
+            ),
+        ]:
+            block = cache.get(family, key)
+            if block is None:
+                columns = list(full_data.columns)
+                full_data = add_features(full_data)
+                cache.put(family, key, full_data.drop(columns=columns))
+            else:
+                full_data = pd.concat([full_data, block], axis=1)
+        if self.rolling_stats:
+            # The statistics read every month of the cube before the label month
+            rolling_key = cache.get_key(
+                versions["rolling_stats"],
+                index_key,
+                self.end_block_num,
+                cube.item_cnt[:, : self.end_block_num],
+                self.clip_threshold,
+                self.rolling_horizons,
+            )
+            block = cache.get("rolling_stats", rolling_key)
+            if block is None:
+                block = self._get_rolling_stats(cube)
+                cache.put("rolling_stats", rolling_key, block)
+            full_data = pd.concat([full_data, block], axis=1)
+        # Means of groups without sales are missing in the cached mean block
+        return full_data.fillna(0.0)
+
 
-# label_encoder = LabelEncoder()
+# category_encoder = CategoryEncoder.load(config.category_encodings_path)
 # clip_threshold = 20
-# processor = FeatureEngineering(start_block_num=0,end_block_num=34,label_encoder = label_encoder, clip_threshold = clip_threshold)
+# processor = FeatureEngineering(start_block_num=0,end_block_num=34,category_encoder = category_encoder, clip_threshold = clip_threshold)
 # train_data = processor.get_features(prepared_data)
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+
+
+class FeatureCache:
+    """A local cache of feature blocks addressed by the hash of their inputs.
+    A block is the columns one feature family adds to a window. Its key hashes
+    the data the family reads, the version of its code and its parameters, so a
+    change of the prepared data or of one family only misses the blocks that
+    depend on it. Blocks are parquet files, the least recently used ones are
+    removed when the cache grows over max_size_mb.
+    Args:
+        path (str): Directory of the cache.
+        max_size_mb (float): Maximum size of the cache files.
+    Attributes:
+        path (str): Directory of the cache.
+        max_size_mb (float): Maximum size of the cache files.
+    Methods:
+        get_key(*parts): Returns the key of a block from its inputs.
+        get(family, key): Returns the cached block, None if it is not cached.
+        put(family, key, data): Saves a block and evicts the least recently used ones.
+    """
+
+    def __init__(self, path, max_size_mb=2048):
+        """Initializes FeatureCache class with the provided parameters."""
+
+        self.path = path
+        self.max_size_mb = max_size_mb
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def get_key(*parts):
+        """Returns the key of a block from its inputs.
+        Parts are arrays, Series and DataFrames, hashed by their values, or
+        other values hashed by their JSON representation, such as versions,
+        parameters and the keys of the blocks read.
+        """
+
+        digest = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            if isinstance(part, pd.DataFrame):
+                for col in part.columns:
+                    digest.update(str(col).encode())
+                    _update_array(digest, part[col].to_numpy())
+            elif isinstance(part, pd.Series):
+                _update_array(digest, part.to_numpy())
+            elif isinstance(part, np.ndarray):
+                _update_array(digest, part)
+            else:
+                digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def _get_path(self, family, key):
+        return os.path.join(self.path, f"{family}-{key}.parquet")
+
+    def get(self, family, key):
+        """Returns the cached block, None if it is not cached."""
+
+        path = self._get_path(family, key)
+        try:
+            data = pd.read_parquet(path)
+            # The access time of a block is its modification time, used by the eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        # Parquet stores the column names as strings, the month columns are integers
+        return data.set_axis(
+            [int(col) if col.isdigit() else col for col in data.columns], axis=1
+        )
+
+    def put(self, family, key, data):
+        """Saves a block and evicts the least recently used ones."""
+
+        path = self._get_path(family, key)
+        # Blocks are written under a temporary name and renamed, so that processes
+        # sharing the cache never read a partial file
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        data.set_axis([str(col) for col in data.columns], axis=1).to_parquet(
+            tmp_path, index=False
+        )
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".parquet"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in files)
+        max_size = self.max_size_mb * 1024**2
+        for _, size, path in sorted(files):
+            if total_size <= max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+def _update_array(digest, values):
+    # Dtype, shape and bytes of the values, object arrays by their text
+    values = np.asarray(values)
+    digest.update(f"{values.dtype.str}{values.shape}".encode())
+    if values.dtype == object:
+        digest.update("\x00".join(map(str, values.ravel())).encode())
+    else:
+        digest.update(np.ascontiguousarray(values).data)
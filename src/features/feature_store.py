@@ -0,0 +1,251 @@
+import json
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import config
+from src.data.category_encoder import CategoryEncoder
+from src.data.schema import DATA_DTYPES
+from src.features.build_features import FeatureEngineering
+from src.features.sales_cube import SalesCube
+from utils import get_data, load_data
+import click
+import numpy as np
+import pandas as pd
+
+
+@click.command()
+@click.argument("prepared_data_path", type=click.Path(exists=True))
+@click.argument("snapshot_path", type=click.Path())
+@click.option(
+    "--encodings-path",
+    default=config.category_encodings_path,
+    type=click.Path(exists=True),
+    help="Category codes saved by the ELT stage.",
+)
+def main(prepared_data_path, snapshot_path, encodings_path):
+    # The served features are the features of the window ending in the test month
+    sales_cube = SalesCube.from_data(load_data(prepared_data_path, DATA_DTYPES))
+    test_block_num = sales_cube.n_blocks - 1
+    processor = FeatureEngineering(
+        start_block_num=test_block_num - 12,
+        end_block_num=test_block_num,
+        category_encoder=CategoryEncoder.load(encodings_path),
+    )
+    X_test, _ = get_data(processor.get_features(sales_cube))
+    FeatureStore.from_features(X_test).save(snapshot_path)
+
+
+class FeatureStore:
+    """In-process store of the features of the latest window for lookups by shop and item.
+    Rows are indexed by the sorted integer key of (shop_id, item_id), so a batch
+    of pairs is found with one binary search. Pairs that are not in the window get
+    the features of their groups: the attributes of the item and the shop, the
+    group means of the groups they belong to and no sales. The store is saved as
+    a directory of .npy files that load memory-maps, so a service starts without
+    reading the features.
+    Args:
+        keys (ndarray): Sorted keys of the (shop_id, item_id) pairs of the rows.
+        features (dict): Feature arrays of the rows in the order of the keys.
+        tables (dict): Sorted keys and values of every lookup table of the fallback.
+        constants (dict): Features with the same value in every row, such as the month.
+    Attributes:
+        attribute_tables (dict): Key columns and value columns of the attribute tables.
+        group_features (dict): Key columns of every group mean feature.
+        constant_features (list): Features with the same value in every row.
+        missing_values (dict): Features of a pair without sales that are not zero.
+        keys (ndarray): Sorted keys of the (shop_id, item_id) pairs of the rows.
+        features (dict): Feature arrays of the rows in the order of the keys.
+        tables (dict): Sorted keys and values of every lookup table of the fallback.
+        constants (dict): Features with the same value in every row, such as the month.
+    Methods:
+        from_features(X): Builds the store from the features of a window.
+        get_features(pairs): Returns the features of the pairs.
+        get_feature_arrays(shop_ids, item_ids): Returns the features of the pairs as a dict of arrays.
+        save(path): Saves the store to a directory of .npy files.
+        load(path, mmap_mode): Loads the store saved by save, memory-mapped by default.
+    """
+
+    attribute_tables = {
+        "item": (("item_id",), ("item_category_id", "item_category_name")),
+        "shop": (("shop_id",), ("shop_name",)),
+        "category": (("item_category_id",), ("cat_price_cat",)),
+    }
+    group_features = {
+        "shop_item_cnt_mean": ("shop_id", "item_id"),
+        "shop_item_category_cnt_mean_x": ("shop_id", "item_category_name"),
+        "shop_item_category_cnt_mean_y": ("shop_id", "item_category_name"),
+        "sity_item_id_cnt_mean": ("shop_name", "item_id"),
+        "sity_category_id_cnt_mean": ("shop_name", "item_category_id"),
+        "sity_item_category": ("shop_name", "item_category_name"),
+        "shop_item_cat_cnt_cat": ("shop_id", "cat_price_cat"),
+        "sity_item_cat_cnt_cat": ("shop_name", "cat_price_cat"),
+    }
+    constant_features = ["year", "season", "month"]
+    # Features of a pair without sales that are not zero, see RollingStats.get_features
+    missing_values = {"months_since_first_sale": -1, "months_since_last_sale": -1}
+
+    def __init__(self, keys, features, tables, constants):
+        """Initializes FeatureStore class with the provided parameters."""
+
+        self.keys = keys
+        self.features = features
+        self.tables = tables
+        self.constants = constants
+
+    @classmethod
+    def from_features(cls, X):
+        """Builds the store from the features of a window, as returned by get_data."""
+
+        keys = _get_keys(X["shop_id"], X["item_id"])
+        order = np.argsort(keys, kind="stable")
+        features = {col: X[col].to_numpy()[order] for col in X.columns}
+
+        tables = {}
+        for name, (key_columns, value_columns) in cls.attribute_tables.items():
+            tables[name] = _get_table(X, key_columns, value_columns)
+        for name, key_columns in cls.group_features.items():
+            tables[name] = _get_table(X, key_columns, (name,))
+        constants = {
+            col: X[col].iloc[0].item() for col in cls.constant_features if len(X)
+        }
+        return cls(keys[order], features, tables, constants)
+
+    def get_features(self, pairs):
+        """Returns the features of the pairs, a DataFrame with the shop_id and item_id columns
+        or a list of (shop_id, item_id) tuples, in the order of the pairs.
+        """
+
+        if isinstance(pairs, pd.DataFrame):
+            shop_ids = pairs["shop_id"].to_numpy()
+            item_ids = pairs["item_id"].to_numpy()
+        else:
+            pairs = np.asarray(list(pairs), dtype=np.int64).reshape(-1, 2)
+            shop_ids, item_ids = pairs[:, 0], pairs[:, 1]
+        return pd.DataFrame(self.get_feature_arrays(shop_ids, item_ids))
+
+    def get_feature_arrays(self, shop_ids, item_ids):
+        """Returns the features of the pairs of the shop and item ids, scalars or arrays,
+        as a dict of arrays. Lookups of a few pairs skip the DataFrames of get_features.
+        """
+
+        shop_ids = np.atleast_1d(shop_ids)
+        item_ids = np.atleast_1d(item_ids)
+        positions, found = _search(self.keys, _get_keys(shop_ids, item_ids))
+        if found.all():
+            return {col: values[positions] for col, values in self.features.items()}
+
+        rows = positions[found]
+        features = {}
+        for col, values in self.features.items():
+            features[col] = np.zeros(len(found), dtype=values.dtype)
+            features[col][found] = values[rows]
+        self._fill_missing(features, ~found, shop_ids, item_ids)
+        return features
+
+    def _fill_missing(self, features, missing, shop_ids, item_ids):
+        # Pairs without a row get the attributes and group means of their groups,
+        # the lags and prices stay zero as for a pair without sales
+        values = {"shop_id": shop_ids[missing], "item_id": item_ids[missing]}
+        for name, (key_columns, value_columns) in self.attribute_tables.items():
+            looked_up = self._lookup(name, [values[col] for col in key_columns])
+            for col, col_values in zip(value_columns, looked_up):
+                values[col] = col_values
+        for name, key_columns in self.group_features.items():
+            (values[name],) = self._lookup(name, [values[col] for col in key_columns])
+        values.update(self.constants)
+        values.update(self.missing_values)
+        for col, col_values in values.items():
+            if col in features:
+                features[col][missing] = col_values
+
+    def _lookup(self, name, key_values):
+        # Values of the table for the keys, unknown keys get the unknown category code or 0
+        table = self.tables[name]
+        keys = _get_keys(*key_values)
+        positions, found = _search(table["keys"], keys)
+        default = CategoryEncoder.unknown_code if name in self.attribute_tables else 0
+        result = []
+        for values in table["values"]:
+            looked_up = np.full(len(keys), default, dtype=values.dtype)
+            looked_up[found] = values[positions[found]]
+            result.append(looked_up)
+        return result
+
+    def save(self, path):
+        """Saves the store to a directory of .npy files and a manifest."""
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "keys.npy"), self.keys)
+        for i, (col, values) in enumerate(self.features.items()):
+            np.save(os.path.join(path, f"feature_{i}.npy"), values)
+        for name, table in self.tables.items():
+            np.save(os.path.join(path, f"{name}.keys.npy"), table["keys"])
+            for i, values in enumerate(table["values"]):
+                np.save(os.path.join(path, f"{name}.values_{i}.npy"), values)
+        manifest = {
+            "features": list(self.features),
+            "tables": {
+                name: len(table["values"]) for name, table in self.tables.items()
+            },
+            "constants": self.constants,
+        }
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """Loads the store saved by save, memory-mapped by default."""
+
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+
+        def load_array(file_name):
+            return np.load(os.path.join(path, file_name), mmap_mode=mmap_mode)
+
+        features = {
+            col: load_array(f"feature_{i}.npy")
+            for i, col in enumerate(manifest["features"])
+        }
+        tables = {
+            name: {
+                "keys": load_array(f"{name}.keys.npy"),
+                "values": [
+                    load_array(f"{name}.values_{i}.npy") for i in range(n_values)
+                ],
+            }
+            for name, n_values in manifest["tables"].items()
+        }
+        return cls(load_array("keys.npy"), features, tables, manifest["constants"])
+
+
+def _get_keys(*columns):
+    # Integer key of one integer column or of a pair of them, the pair is packed
+    # into the two halves of an int64 with the unknown code -1 shifted to 0
+    if len(columns) == 1:
+        return np.asarray(columns[0], dtype=np.int64)
+    first, second = (np.asarray(col, dtype=np.int64) + 1 for col in columns)
+    return (first << 32) | second
+
+
+def _get_table(X, key_columns, value_columns):
+    # Sorted keys and values of the first row of every key, the values are the same in a group
+    groups = X.drop_duplicates(list(key_columns))
+    keys = _get_keys(*[groups[col] for col in key_columns])
+    order = np.argsort(keys, kind="stable")
+    return {
+        "keys": keys[order],
+        "values": [groups[col].to_numpy()[order] for col in value_columns],
+    }
+
+
+def _search(sorted_keys, keys):
+    # Positions of the keys in the sorted keys and whether they are there
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return positions, sorted_keys[positions] == keys
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import numpy as np
+
+
+class GroupAggregator:
+    """Vectorized group means of the lag columns for a part of the dataset.
+    Every key combination is factorized into integer codes once, group sums and
+    counts of all lag columns are computed in one bincount pass and the means are
+    broadcast back to the rows by the codes instead of merging.
+    Args:
+        data (DataFrame): The part of the dataset with the key columns.
+    Attributes:
+        data (DataFrame): The part of the dataset with the key columns.
+    Methods:
+        get_codes(keys): Returns group codes of the rows and the number of groups.
+        get_group_keys(keys): Returns the key values of every group.
+        get_group_sums(keys, values, skip_zeros): Returns sums and counts of the values by group.
+        get_group_means(keys, values, skip_zeros): Returns the mean of the column group means of every row.
+    """
+
+    def __init__(self, data):
+        """Initializes GroupAggregator class with the provided parameters."""
+
+        self.data = data
+        self._codes = {}
+
+    def get_codes(self, keys):
+        """Returns group codes of the rows and the number of groups.
+        Rows with a missing key get the code -1.
+        """
+
+        keys = tuple(keys)
+        if keys not in self._codes:
+            codes = (
+                self.data.groupby(list(keys), sort=False, observed=True)
+                .ngroup()
+                .fillna(-1)
+                .to_numpy(dtype=np.int64)
+            )
+            self._codes[keys] = (codes, int(codes.max()) + 1)
+        return self._codes[keys]
+
+    def get_group_keys(self, keys):
+        """Returns the key values of every group, one row per group code."""
+
+        codes, n_groups = self.get_codes(keys)
+        # Codes are dense, so the last n_groups unique codes are 0..n_groups-1 without -1
+        _, first_rows = np.unique(codes, return_index=True)
+        return (
+            self.data[list(keys)]
+            .iloc[first_rows[len(first_rows) - n_groups :]]
+            .reset_index(drop=True)
+        )
+
+    def get_group_sums(self, keys, values, skip_zeros=False):
+        """Returns sums and counts of the values by group, both of shape (n_groups, n_columns).
+        With skip_zeros only non-zero values are counted, as if zeros were missing.
+        """
+
+        codes, n_groups = self.get_codes(keys)
+        values = np.asarray(values, dtype=float)
+        n_columns = values.shape[1]
+        observed = codes >= 0
+        codes, values = codes[observed], values[observed]
+
+        cell_codes = (codes[:, None] * n_columns + np.arange(n_columns)).ravel()
+        size = n_groups * n_columns
+        sums = np.bincount(cell_codes, weights=values.ravel(), minlength=size)
+        if skip_zeros:
+            counts = np.bincount(
+                cell_codes, weights=(values != 0).ravel(), minlength=size
+            )
+        else:
+            counts = np.repeat(np.bincount(codes, minlength=n_groups), n_columns)
+        return sums.reshape(n_groups, n_columns), counts.reshape(n_groups, n_columns)
+
+    def get_group_means(self, keys, values, skip_zeros=False):
+        """Returns the mean of the column group means of every row.
+        Columns without values in the group are skipped and rows whose group has
+        no values at all or a missing key get NaN.
+        """
+
+        sums, counts = self.get_group_sums(keys, values, skip_zeros)
+        return self.broadcast(keys, self.get_means(sums, counts))
+
+    @staticmethod
+    def get_means(sums, counts):
+        """Returns the mean of the column means of every group from its sums and counts."""
+
+        column_means = np.divide(
+            sums, counts, out=np.full(sums.shape, np.nan), where=counts > 0
+        )
+        # Columns are reduced one by one as pandas does for the groupby result
+        column_means = np.ascontiguousarray(column_means.T)
+        n_columns = (counts > 0).sum(axis=1)
+        total = np.where(np.isnan(column_means), 0.0, column_means).sum(axis=0)
+        return np.divide(
+            total, n_columns, out=np.full(total.shape, np.nan), where=n_columns > 0
+        )
+
+    def broadcast(self, keys, group_values):
+        """Returns the group values for every row, NaN for rows with a missing key."""
+
+        codes, _ = self.get_codes(keys)
+        return np.where(codes >= 0, group_values[codes], np.nan)
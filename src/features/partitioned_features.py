@@ -0,0 +1,300 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+from src.features.build_features import FeatureEngineering
+from src.features.group_aggregator import GroupAggregator
+from src.features.sales_cube import SalesCube
+from src.tracing import traced, tracer
+
+# Sales cube of a worker process, loaded once by _init_worker
+_worker_cube = None
+
+
+class ShardFeatureEngineering(FeatureEngineering):
+    """FeatureEngineering of a shard of shops with the aggregates over shops given.
+    Group means keyed by shop_id are computed from the rows of the shard, the
+    means of the other keys and the mean category prices are taken from the
+    reduce step of PartitionedFeatureEngineering. A shard has only the rows of
+    its shops, so the group means are not read from a rollup cube.
+    Args:
+        start_block_num (int): The starting block number for feature generation.
+        end_block_num (int): The ending block number for feature generation.
+        category_encoder (CategoryEncoder): The dictionary of stable codes of categorical features.
+        group_means (dict): Means of every group by key columns, Series indexed by the key values.
+        category_means (Series): Mean last month price by item_category_id over all shops.
+        rolling_stats (bool): Whether to add the rolling statistics of the item count.
+    Attributes:
+        group_means (dict): Means of every group by key columns, Series indexed by the key values.
+        category_means (Series): Mean last month price by item_category_id over all shops.
+    """
+
+    def __init__(
+        self,
+        start_block_num,
+        end_block_num,
+        category_encoder,
+        group_means,
+        category_means,
+        rolling_stats=False,
+    ):
+        """Initializes ShardFeatureEngineering class with the provided parameters."""
+
+        super().__init__(
+            start_block_num,
+            end_block_num,
+            category_encoder,
+            rolling_stats=rolling_stats,
+            use_rollup=False,
+        )
+        self.group_means = group_means
+        self.category_means = category_means
+
+    def _get_group_means(self, aggregator, keys, values, skip_zeros=False):
+        """Returns the group means of the values for every row, the given means for keys over shops."""
+
+        group_means = self.group_means.get(tuple(keys))
+        if group_means is None:
+            return super()._get_group_means(aggregator, keys, values, skip_zeros)
+        group_values = group_means.reindex(
+            _get_key_index(aggregator.get_group_keys(keys), keys)
+        ).to_numpy()
+        return aggregator.broadcast(keys, group_values)
+
+    def _get_category_means(self, data):
+        """Returns the mean last month price of every item category over all shops."""
+
+        return self.category_means
+
+
+class PartitionedFeatureEngineering:
+    """Feature generation of a window in shards of shops, for windows larger than memory.
+    Rows of the cube are sorted by shop_id, so a shard is a contiguous range of
+    rows holding whole shops. The group means keyed by shop_id only need the rows
+    of their shop. The means keyed by shop_name and the mean category prices,
+    which need the rows of all shops, are computed in a map/reduce step first:
+    every shard returns its group sums and counts, they are summed over the
+    shards and the means are joined back to the shards when their features are
+    generated. With a memory-mapped cube only the rows of the current shards are
+    read, sequentially or in the worker processes of an executor started once
+    by get_shard_executor for all the windows of a run.
+    Args:
+        start_block_num (int): The starting block number for feature generation.
+        end_block_num (int): The ending block number for feature generation.
+        category_encoder (CategoryEncoder): The dictionary of stable codes of categorical features.
+        memory_budget_mb (float): Approximate memory of a shard, a shard holds at least one shop.
+        executor (ProcessPoolExecutor): Workers of get_shard_executor on the saved cube, None to generate the shards in this process.
+        rolling_stats (bool): Whether to add the rolling statistics of the item count.
+    Attributes:
+        cross_shop_keys (list): Keys of the group means that need the rows of all shops.
+        price_category_keys (tuple): Keys of the mean by price bin over shops.
+        row_bytes (int): Approximate peak memory of a window row in get_features.
+        start_block_num (int): The starting block number for feature generation.
+        end_block_num (int): The ending block number for feature generation.
+        category_encoder (CategoryEncoder): The dictionary of stable codes of categorical features.
+        memory_budget_mb (float): Approximate memory of a shard.
+        executor (ProcessPoolExecutor): Workers of get_shard_executor on the saved cube, None to generate the shards in this process.
+        rolling_stats (bool): Whether to add the rolling statistics of the item count.
+    Methods:
+        get_shards(cube): Returns the row ranges of the shards.
+        iter_features(cube): Yields the features of every shard in the order of the cube rows.
+        get_features(cube): Returns the features of the whole window.
+    """
+
+    cross_shop_keys = [
+        ("shop_name", "item_id"),
+        ("shop_name", "item_category_id"),
+        ("shop_name", "item_category_name"),
+    ]
+    price_category_keys = ("shop_name", "cat_price_cat")
+    row_bytes = 1024
+
+    def __init__(
+        self,
+        start_block_num,
+        end_block_num,
+        category_encoder,
+        memory_budget_mb=1024,
+        executor=None,
+        rolling_stats=False,
+    ):
+        """Initializes PartitionedFeatureEngineering class with the provided parameters."""
+
+        self.start_block_num = start_block_num
+        self.end_block_num = end_block_num
+        self.category_encoder = category_encoder
+        self.memory_budget_mb = memory_budget_mb
+        self.executor = executor
+        self.rolling_stats = rolling_stats
+
+    def get_shards(self, cube):
+        """Returns the (start, stop) row ranges of the shards, whole shops within the memory budget."""
+
+        shop_ids = np.asarray(cube.index["shop_id"])
+        bounds = np.flatnonzero(np.diff(shop_ids)) + 1
+        bounds = np.concatenate([bounds, [len(shop_ids)]])
+        max_rows = max(int(self.memory_budget_mb * 1024**2) // self.row_bytes, 1)
+        shards = []
+        start = previous = 0
+        for stop in bounds:
+            if stop - start > max_rows and previous > start:
+                shards.append((start, previous))
+                start = previous
+            previous = stop
+        shards.append((start, previous))
+        return shards
+
+    @traced
+    def _reduce(self, partials):
+        # Sums the group sums of the shards and returns the processor of the shards
+        group_means = {}
+        for keys in self.cross_shop_keys:
+            group_keys, sums, counts = _reduce_group_sums(
+                [partial[keys] for partial in partials], keys
+            )
+            group_means[keys] = pd.Series(
+                GroupAggregator.get_means(sums, counts),
+                index=_get_key_index(group_keys, keys),
+            )
+
+        keys = ("item_category_id",)
+        group_keys, sums, counts = _reduce_group_sums(
+            [partial["category_prices"] for partial in partials], keys
+        )
+        category_means = pd.Series(
+            sums[:, 0] / counts[:, 0],
+            index=pd.Index(group_keys["item_category_id"].to_numpy(), name=keys[0]),
+        )
+        processor = ShardFeatureEngineering(
+            self.start_block_num,
+            self.end_block_num,
+            self.category_encoder,
+            group_means,
+            category_means,
+            rolling_stats=self.rolling_stats,
+        )
+
+        # The price bins are known only now, so the sums by category are rolled up to the bins
+        keys = ("shop_name", "item_category_id")
+        group_keys, sums, counts = _reduce_group_sums(
+            [partial["category_lags"] for partial in partials], keys
+        )
+        cat_price_cat = processor._get_price_categories(category_means)
+        group_keys["cat_price_cat"] = cat_price_cat.reindex(
+            group_keys["item_category_id"]
+        ).values
+        aggregator = GroupAggregator(group_keys)
+        sums, _ = aggregator.get_group_sums(self.price_category_keys, sums)
+        counts, _ = aggregator.get_group_sums(self.price_category_keys, counts)
+        group_means[self.price_category_keys] = pd.Series(
+            GroupAggregator.get_means(sums, counts),
+            index=_get_key_index(
+                aggregator.get_group_keys(self.price_category_keys),
+                self.price_category_keys,
+            ),
+        )
+        return processor
+
+    def iter_features(self, cube):
+        """Yields the features of every shard in the order of the cube rows."""
+
+        shards = self.get_shards(cube)
+        processor = FeatureEngineering(
+            self.start_block_num, self.end_block_num, self.category_encoder
+        )
+        if self.rolling_stats:
+            # Built once on the whole cube, the shards take their rows of it
+            cube.get_rolling_stats(processor.clip_threshold)
+        if self.executor is not None:
+            # Workers read the shards from their memory-mapped copy of the same cube
+            partials = list(
+                self.executor.map(_get_worker_shard_sums, repeat(processor), shards)
+            )
+            shard_processor = self._reduce(partials)
+            yield from self.executor.map(
+                _get_worker_shard_features, repeat(shard_processor), shards
+            )
+            return
+        partials = [
+            _get_shard_sums(processor, cube.get_rows(start, stop))
+            for start, stop in shards
+        ]
+        shard_processor = self._reduce(partials)
+        for start, stop in shards:
+            with tracer.step("shard", attributes={"rows": stop - start}):
+                yield shard_processor.get_features(cube.get_rows(start, stop))
+
+    def get_features(self, cube):
+        """Returns the features of the whole window, the same as FeatureEngineering.get_features."""
+
+        return pd.concat(list(self.iter_features(cube)), ignore_index=True)
+
+
+def _get_key_index(group_keys, keys):
+    # Index of the key values, categorical keys are matched by their values
+    return pd.MultiIndex.from_arrays(
+        [np.asarray(group_keys[key]) for key in keys], names=list(keys)
+    )
+
+
+def _get_shard_sums(processor, cube):
+    # Group sums and counts of the shard for the aggregates over shops
+    data = pd.concat(
+        [processor._get_price_dynamics(cube), processor._lag_item_count(cube)], axis=1
+    )
+    lag_columns = [col for col in data.columns if isinstance(col, int)][:-1]
+    lags = data[lag_columns].to_numpy()
+    aggregator = GroupAggregator(data)
+    partial = {}
+    for keys in PartitionedFeatureEngineering.cross_shop_keys:
+        sums, counts = aggregator.get_group_sums(keys, lags, skip_zeros=True)
+        partial[keys] = (aggregator.get_group_keys(keys), sums, counts)
+    keys = ("item_category_id",)
+    sums, counts = aggregator.get_group_sums(keys, data[["Price 1"]].to_numpy())
+    partial["category_prices"] = (aggregator.get_group_keys(keys), sums, counts)
+    keys = ("shop_name", "item_category_id")
+    sums, counts = aggregator.get_group_sums(keys, lags)
+    partial["category_lags"] = (aggregator.get_group_keys(keys), sums, counts)
+    return partial
+
+
+def _reduce_group_sums(partials, keys):
+    # Sums the group sums and counts of the shards by the key values
+    group_keys = pd.concat([partial[0] for partial in partials], ignore_index=True)
+    aggregator = GroupAggregator(group_keys)
+    sums, _ = aggregator.get_group_sums(
+        keys, np.vstack([partial[1] for partial in partials])
+    )
+    counts, _ = aggregator.get_group_sums(
+        keys, np.vstack([partial[2] for partial in partials])
+    )
+    return aggregator.get_group_keys(keys), sums, counts
+
+
+def get_shard_executor(cube_path, jobs):
+    """Returns a pool of jobs worker processes memory-mapping the cube saved in cube_path by SalesCube.save.
+    The pool is started once and generates the shards of every window of PartitionedFeatureEngineering.
+    """
+
+    return ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_worker, initargs=(cube_path,)
+    )
+
+
+def _init_worker(cube_path):
+    global _worker_cube
+    tracer.disable()
+    _worker_cube = SalesCube.load(cube_path, mmap_mode="r")
+
+
+def _get_worker_shard_sums(processor, shard):
+    return _get_shard_sums(processor, _worker_cube.get_rows(*shard))
+
+
+def _get_worker_shard_features(processor, shard):
+    if processor.rolling_stats:
+        # Built once per worker on its memory-mapped cube
+        _worker_cube.get_rolling_stats(processor.clip_threshold)
+    return processor.get_features(_worker_cube.get_rows(*shard))
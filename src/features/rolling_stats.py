@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+
+
+class RollingStats:
+    """Rolling statistics of the monthly item count from its prefix sums.
+    The prefix sums of the count, of its square and of the count weighted by the
+    month are computed once over the whole shop-item by month matrix, together
+    with the month of the last sale up to every month and the month of the first
+    sale. The mean, standard deviation and trend slope over any horizon before
+    any month are then differences of two prefix columns, so a window costs a
+    few vector operations per horizon instead of a pass over its months.
+    Args:
+        count_sums (ndarray): Prefix sums of the count, shape (n_rows, n_blocks + 1).
+        square_sums (ndarray): Prefix sums of the squared count, shape (n_rows, n_blocks + 1).
+        month_sums (ndarray): Prefix sums of the count times its month, shape (n_rows, n_blocks + 1).
+        last_sale (ndarray): Month of the last sale up to every month, -1 before the first one.
+        first_sale (ndarray): Month of the first sale of every row, n_blocks without sales.
+    Attributes:
+        dtype (str): Dtype of the prefix sums.
+        row_chunk_size (int): Rows of the matrix processed at a time by from_counts.
+    Methods:
+        from_counts(item_cnt, clip_threshold): Builds the prefix sums of the clipped item count.
+        get_rows(start, stop): Returns the statistics of the rows from start to stop.
+        get_features(end_block_num, horizons): Returns the statistics of the months before end_block_num.
+    """
+
+    dtype = "float32"
+    row_chunk_size = 1 << 16
+
+    def __init__(self, count_sums, square_sums, month_sums, last_sale, first_sale):
+        """Initializes RollingStats class with the provided parameters."""
+
+        self.count_sums = count_sums
+        self.square_sums = square_sums
+        self.month_sums = month_sums
+        self.last_sale = last_sale
+        self.first_sale = first_sale
+
+    @property
+    def n_blocks(self):
+        return self.last_sale.shape[1]
+
+    @classmethod
+    def from_counts(cls, item_cnt, clip_threshold):
+        """Builds the prefix sums of the item count clipped to [0, clip_threshold] as the lags.
+        The matrix is processed in chunks of rows, so a memory-mapped cube is read once
+        and the float64 intermediates stay small.
+        """
+
+        n_rows, n_blocks = item_cnt.shape
+        months = np.arange(n_blocks)
+        sums = [np.zeros((n_rows, n_blocks + 1), dtype=cls.dtype) for _ in range(3)]
+        last_sale = np.empty((n_rows, n_blocks), dtype=np.int16)
+        first_sale = np.empty(n_rows, dtype=np.int16)
+        for start in range(0, n_rows, cls.row_chunk_size):
+            stop = min(start + cls.row_chunk_size, n_rows)
+            counts = np.clip(
+                np.asarray(item_cnt[start:stop], dtype=np.float64), 0, clip_threshold
+            )
+            for prefix_sums, values in zip(sums, [counts, counts**2, counts * months]):
+                np.cumsum(values, axis=1, out=prefix_sums[start:stop, 1:])
+            sold = counts > 0
+            np.maximum.accumulate(
+                np.where(sold, months, -1), axis=1, out=last_sale[start:stop]
+            )
+            first_sale[start:stop] = np.where(
+                sold.any(axis=1), sold.argmax(axis=1), n_blocks
+            )
+        return cls(*sums, last_sale, first_sale)
+
+    def get_rows(self, start, stop):
+        """Returns the statistics of the rows from start to stop, the arrays are views."""
+
+        return RollingStats(
+            self.count_sums[start:stop],
+            self.square_sums[start:stop],
+            self.month_sums[start:stop],
+            self.last_sale[start:stop],
+            self.first_sale[start:stop],
+        )
+
+    def get_features(self, end_block_num, horizons):
+        """Returns the statistics of the months before end_block_num.
+        For every horizon h the mean, standard deviation and least squares slope of
+        the count over the h months before end_block_num, fewer at the start of the
+        data, and the months since the first and the last sale, -1 without sales.
+        """
+
+        features = {}
+        end = end_block_num
+        for horizon in horizons:
+            start = max(end - horizon, 0)
+            n = end - start
+            if n == 0:
+                for name in ["rolling_mean", "rolling_std", "rolling_slope"]:
+                    features[f"{name} {horizon}"] = np.zeros(len(self.first_sale))
+                continue
+            count_sum = _get_range_sum(self.count_sums, start, end)
+            square_sum = _get_range_sum(self.square_sums, start, end)
+            # The months of the range are counted from its start
+            month_sum = _get_range_sum(self.month_sums, start, end) - start * count_sum
+            mean = count_sum / n
+            features[f"rolling_mean {horizon}"] = mean
+            features[f"rolling_std {horizon}"] = np.sqrt(
+                np.maximum(square_sum / n - mean**2, 0)
+            )
+            months_sum = n * (n - 1) / 2
+            months_square_sum = (n - 1) * n * (2 * n - 1) / 6
+            denominator = n * months_square_sum - months_sum**2
+            features[f"rolling_slope {horizon}"] = (
+                (n * month_sum - months_sum * count_sum) / denominator
+                if denominator > 0
+                else np.zeros(len(count_sum))
+            )
+
+        first_sale = self.first_sale.astype(np.int32)
+        features["months_since_first_sale"] = np.where(
+            first_sale < end, end - first_sale, -1
+        )
+        if end > 0:
+            last_sale = self.last_sale[:, min(end, self.n_blocks) - 1].astype(np.int32)
+            features["months_since_last_sale"] = np.where(
+                last_sale >= 0, end - last_sale, -1
+            )
+        else:
+            features["months_since_last_sale"] = np.full(len(first_sale), -1)
+        return pd.DataFrame(features)
+
+
+def _get_range_sum(prefix_sums, start, end):
+    # Sums over the months from start to end exclusive, in float64
+    return prefix_sums[:, end].astype(np.float64) - prefix_sums[:, start]
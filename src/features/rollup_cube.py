@@ -0,0 +1,290 @@
+import numpy as np
+import pandas as pd
+
+from src.features.group_aggregator import GroupAggregator
+
+
+class RollupCube:
+    """Aggregates of the sales cube by month over the shop and item hierarchies.
+    The shop dimension has the levels shop_id and shop_name (the city), the item
+    dimension item_id, item_category_id and item_category_name, a dimension
+    without a key stands for all shops or all items. For a combination of levels
+    the cube holds by group and month the sum and count of the item count and
+    of the item price: sales are the non-zero counts and prices the cells with
+    a price, the groups also keep their number of shop-item rows. A measure of
+    a level is aggregated over all months on its first use, one month at a
+    time, and every window and query takes a slice of its months. Levels with
+    shop_id and item_id are the sales cube itself and are not aggregated. The
+    price bin cat_price_cat of a window is rolled up from the item_category_id
+    level with the bins of the categories. The item count is clipped as the
+    lags are, so FeatureEngineering reads the group means of its lags from the
+    cube.
+    Args:
+        cube (SalesCube): The sales cube aggregated.
+        clip_threshold (int): The item count is clipped to [0, clip_threshold], None to keep it.
+    Attributes:
+        shop_levels (list): Levels of the shop dimension, from the finest.
+        item_levels (list): Levels of the item dimension, from the finest.
+        price_level (str): Level of the price bins, rolled up from item_category_id.
+        cube (SalesCube): The sales cube aggregated.
+        clip_threshold (int): The item count is clipped to [0, clip_threshold], None to keep it.
+    Methods:
+        get_group_sums(keys, start_block_num, end_block_num, skip_zeros, category_bins): Returns sums and counts of the item count by group.
+        get_group_means(keys, start_block_num, end_block_num, skip_zeros, category_bins): Returns the mean of the monthly group means of every cube row.
+        query(keys, start_block_num, end_block_num, measure, category_bins, **filters): Returns the sum, count and mean by group and month.
+    """
+
+    shop_levels = ["shop_id", "shop_name"]
+    item_levels = ["item_id", "item_category_id", "item_category_name"]
+    price_level = "cat_price_cat"
+
+    def __init__(self, cube, clip_threshold=None):
+        """Initializes RollupCube class with the provided parameters."""
+
+        self.cube = cube
+        self.clip_threshold = clip_threshold
+        self._levels = {}
+
+    def _get_level_columns(self, keys):
+        # Columns of the level of the keys in the order of the hierarchies,
+        # the price bins are rolled up from item_category_id
+        columns = set(keys)
+        unknown = columns - set(
+            self.shop_levels + self.item_levels + [self.price_level]
+        )
+        if unknown:
+            raise ValueError(
+                f"Keys {sorted(unknown)} are not levels of the rollup cube"
+            )
+        if self.price_level in columns:
+            columns.add("item_category_id")
+        return tuple(
+            col for col in self.shop_levels + self.item_levels if col in columns
+        )
+
+    def _get_item_cnt(self, start_block_num, end_block_num):
+        item_cnt = self.cube.item_cnt[:, start_block_num:end_block_num]
+        if self.clip_threshold is not None:
+            item_cnt = np.clip(item_cnt, 0, self.clip_threshold)
+        return item_cnt
+
+    def _get_level(self, level):
+        # Group codes of the cube rows and key values of a level
+        if level in self._levels:
+            return self._levels[level]
+        columns = list(level)
+        n_rows = len(self.cube.index)
+        if {"shop_id", "item_id"} <= set(columns):
+            # The finest level is the cube itself, its months are read on demand
+            codes, n_groups = np.arange(n_rows), n_rows
+            keys = self.cube.index[columns].reset_index(drop=True)
+        elif columns:
+            aggregator = GroupAggregator(self.cube.index)
+            codes, n_groups = aggregator.get_codes(columns)
+            keys = aggregator.get_group_keys(columns)
+        else:
+            codes, n_groups = np.zeros(n_rows, dtype=np.int64), 1
+            keys = pd.DataFrame(index=range(1))
+        entry = {
+            "codes": codes,
+            "keys": keys,
+            "n_rows": np.bincount(codes[codes >= 0], minlength=n_groups),
+        }
+        self._levels[level] = entry
+        return entry
+
+    def _get_values(self, measure, start_block_num, end_block_num):
+        # Monthly values of the measure for every cube row
+        if measure == "item_cnt":
+            return self._get_item_cnt(start_block_num, end_block_num).astype(float)
+        if measure == "item_price":
+            return np.asarray(
+                self.cube.item_price[:, start_block_num:end_block_num], dtype=float
+            )
+        raise ValueError(f"Unknown measure {measure}")
+
+    def _get_measure(self, level, measure, start_block_num, end_block_num):
+        # Sums and counts of the non-zero values of the measure by group and month
+        entry = self._get_level(level)
+        if {"shop_id", "item_id"} <= set(level):
+            values = self._get_values(measure, start_block_num, end_block_num)
+            return values, (values != 0).astype(np.int32)
+        if measure not in entry:
+            entry[measure] = self._aggregate(entry, measure)
+        sums, counts = entry[measure]
+        return (
+            sums[:, start_block_num:end_block_num].astype(float),
+            counts[:, start_block_num:end_block_num].astype(np.int64),
+        )
+
+    def _aggregate(self, entry, measure):
+        # Sums and counts of a level for every month, aggregated month by month so
+        # that only one month of the cube is converted to float64 at a time. The rows
+        # of a group are summed in their order as by GroupAggregator, so the sums
+        # of a window are the same as the ones of its groupby. The sums are kept in
+        # float32 while it holds them exactly and the counts in the smallest integer
+        # dtype of the group sizes
+        codes = entry["codes"]
+        observed = codes >= 0
+        codes = codes[observed]
+        n_groups, n_blocks = len(entry["n_rows"]), self.cube.n_blocks
+        sums = np.zeros((n_groups, n_blocks), dtype=np.float32)
+        counts = np.zeros(
+            (n_groups, n_blocks),
+            dtype=np.min_scalar_type(int(entry["n_rows"].max(initial=0))),
+        )
+        for block_num in range(n_blocks):
+            values = self._get_values(measure, block_num, block_num + 1)[observed, 0]
+            block_sums = np.bincount(codes, weights=values, minlength=n_groups)
+            if sums.dtype != block_sums.dtype and not np.array_equal(
+                block_sums.astype(sums.dtype), block_sums
+            ):
+                sums = sums.astype(block_sums.dtype)
+            sums[:, block_num] = block_sums
+            counts[:, block_num] = np.bincount(codes[values != 0], minlength=n_groups)
+        return sums, counts
+
+    def _get_groups(
+        self,
+        keys,
+        start_block_num,
+        end_block_num,
+        measure="item_cnt",
+        skip_zeros=True,
+        category_bins=None,
+    ):
+        # Key values, sums, counts and row codes of the groups of the keys
+        level = self._get_level_columns(keys)
+        entry = self._get_level(level)
+        sums, counts = self._get_measure(level, measure, start_block_num, end_block_num)
+        if not skip_zeros:
+            counts = np.repeat(
+                entry["n_rows"][:, None], end_block_num - start_block_num, axis=1
+            )
+        if self.price_level not in keys:
+            return entry["keys"], sums, counts, entry["codes"]
+
+        if category_bins is None:
+            raise ValueError(f"Keys with {self.price_level} need the category_bins")
+        # Categories are rolled up to their price bins, categories without a bin are left out
+        group_keys = entry["keys"].copy()
+        group_keys[self.price_level] = (
+            pd.Series(category_bins)
+            .reindex(group_keys["item_category_id"].to_numpy())
+            .values
+        )
+        columns = list(keys)
+        aggregator = GroupAggregator(group_keys)
+        sums, _ = aggregator.get_group_sums(columns, sums)
+        counts = aggregator.get_group_sums(columns, counts)[0].astype(np.int64)
+        bin_codes, _ = aggregator.get_codes(columns)
+        codes = entry["codes"]
+        return (
+            aggregator.get_group_keys(columns),
+            sums,
+            counts,
+            np.where(codes >= 0, bin_codes[codes], -1),
+        )
+
+    def get_group_sums(
+        self,
+        keys,
+        start_block_num,
+        end_block_num,
+        skip_zeros=False,
+        category_bins=None,
+    ):
+        """Returns the key values, sums and counts of the item count by group in the months from start to end exclusive.
+        Sums and counts have the shape (n_groups, n_months) as in GroupAggregator.get_group_sums,
+        with skip_zeros only the sales are counted, otherwise the rows of the group.
+        Keys with cat_price_cat need category_bins, the price bins by item_category_id.
+        """
+
+        group_keys, sums, counts, _ = self._get_groups(
+            keys,
+            start_block_num,
+            end_block_num,
+            skip_zeros=skip_zeros,
+            category_bins=category_bins,
+        )
+        return group_keys, sums, counts
+
+    def get_group_means(
+        self,
+        keys,
+        start_block_num,
+        end_block_num,
+        skip_zeros=False,
+        category_bins=None,
+    ):
+        """Returns the mean of the monthly group means of every cube row, as GroupAggregator.get_group_means
+        of the lags of the months from start to end exclusive.
+        """
+
+        _, sums, counts, codes = self._get_groups(
+            keys,
+            start_block_num,
+            end_block_num,
+            skip_zeros=skip_zeros,
+            category_bins=category_bins,
+        )
+        means = GroupAggregator.get_means(sums, counts)
+        return np.where(codes >= 0, means[codes], np.nan)
+
+    def query(
+        self,
+        keys,
+        start_block_num=0,
+        end_block_num=None,
+        measure="item_cnt",
+        category_bins=None,
+        **filters,
+    ):
+        """Returns the sum, count and mean of the measure by group and month, one row per group and month.
+        The measure is item_cnt, counted over the sales, or item_price, counted over
+        the cells with a price. Filters keep the groups with the given key values, such
+        as query(["shop_id"], shop_name=3) to drill down from a city to its shops.
+        """
+
+        if end_block_num is None:
+            end_block_num = self.cube.n_blocks
+        filter_keys = [key for key in filters if key not in keys]
+        group_keys, sums, counts, _ = self._get_groups(
+            list(keys) + filter_keys,
+            start_block_num,
+            end_block_num,
+            measure=measure,
+            category_bins=category_bins,
+        )
+        selected = np.ones(len(group_keys), dtype=bool)
+        for key, value in filters.items():
+            selected &= np.isin(group_keys[key].to_numpy(), np.atleast_1d(value))
+        group_keys = group_keys.loc[selected, list(keys)].reset_index(drop=True)
+        sums, counts = sums[selected], counts[selected]
+        if filter_keys and keys:
+            # The groups of the filter keys are summed up to the requested keys
+            aggregator = GroupAggregator(group_keys)
+            sums, _ = aggregator.get_group_sums(list(keys), sums)
+            counts = aggregator.get_group_sums(list(keys), counts)[0].astype(np.int64)
+            group_keys = aggregator.get_group_keys(list(keys))
+        elif filter_keys:
+            sums = sums.sum(axis=0, keepdims=True)
+            counts = counts.sum(axis=0, keepdims=True)
+            group_keys = pd.DataFrame(index=range(1))
+
+        n_groups, n_months = sums.shape
+        result = group_keys.loc[np.repeat(np.arange(n_groups), n_months)].reset_index(
+            drop=True
+        )
+        result["date_block_num"] = np.tile(
+            np.arange(start_block_num, end_block_num), n_groups
+        )
+        result["sum"] = sums.ravel()
+        result["count"] = counts.ravel()
+        result["mean"] = np.divide(
+            result["sum"],
+            result["count"],
+            out=np.full(len(result), np.nan),
+            where=result["count"].to_numpy() > 0,
+        )
+        return result
@@ -0,0 +1,192 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.features.rolling_stats import RollingStats
+from src.features.rollup_cube import RollupCube
+
+
+class SalesCube:
+    """Dense shop-item by month matrices of the item count and the item price.
+    The cube is built once from the prepared data and every training window
+    takes its lag and price columns as a slice of it.
+    Args:
+        index (DataFrame): Attributes of the cube rows, one row per shop-item pair.
+        item_cnt (ndarray): Monthly item count, shape (n_rows, n_blocks).
+        item_price (ndarray): Monthly mean item price, shape (n_rows, n_blocks).
+    Attributes:
+        index_columns (list): Columns identifying a cube row.
+        dtype (str): Dtype of the matrices.
+        index (DataFrame): Attributes of the cube rows, one row per shop-item pair.
+        item_cnt (ndarray): Monthly item count, shape (n_rows, n_blocks).
+        item_price (ndarray): Monthly mean item price, shape (n_rows, n_blocks).
+    Methods:
+        from_data(data): Builds the cube from the prepared data.
+        get_rows(start, stop): Returns the cube of the rows from start to stop.
+        get_item_cnt(start_block_num, end_block_num): Returns item count columns of the blocks.
+        get_item_price(start_block_num, end_block_num): Returns item price columns of the blocks.
+        get_rolling_stats(clip_threshold): Returns the rolling statistics of the clipped item count.
+        get_rollup(clip_threshold): Returns the rollup cube of the clipped item count.
+        save(path): Saves the cube to a directory of .npy files.
+        load(path, mmap_mode): Loads the cube saved by save, optionally memory-mapped.
+    """
+
+    index_columns = [
+        "shop_id",
+        "item_category_id",
+        "item_id",
+        "item_category_name",
+        "shop_name",
+    ]
+    dtype = "float32"
+
+    def __init__(self, index, item_cnt, item_price):
+        """Initializes SalesCube class with the provided parameters."""
+
+        self.index = index
+        self.item_cnt = item_cnt
+        self.item_price = item_price
+        # Rolling statistics by clip threshold, built on first use and shared by the windows
+        self._rolling_stats = {}
+        # Rollup cubes by clip threshold, aggregated over all rows so not kept by get_rows
+        self._rollups = {}
+
+    @property
+    def n_blocks(self):
+        return self.item_cnt.shape[1]
+
+    @classmethod
+    def from_data(cls, data):
+        """Builds the cube from the prepared data.
+        Rows are sorted the same way as the pivot table of the prepared data
+        and months without sales are filled with zeros.
+        """
+
+        row_codes, index = pd.MultiIndex.from_frame(data[cls.index_columns]).factorize(
+            sort=True
+        )
+        n_rows = len(index)
+        n_blocks = int(data["date_block_num"].max()) + 1
+        cell_codes = row_codes * n_blocks + data["date_block_num"].to_numpy()
+        size = n_rows * n_blocks
+
+        if pd.Index(cell_codes).is_unique:
+            # The prepared data has one row per cell, the values are written
+            # directly into the float32 matrices without float64 intermediates
+            item_cnt = np.zeros(size, dtype=cls.dtype)
+            item_price = np.zeros(size, dtype=cls.dtype)
+            item_cnt[cell_codes] = data["item_cnt"].to_numpy()
+            item_price[cell_codes] = data["item_price"].to_numpy()
+        else:
+            item_cnt = np.bincount(
+                cell_codes, weights=data["item_cnt"].to_numpy(), minlength=size
+            ).astype(cls.dtype)
+            price_sum = np.bincount(
+                cell_codes, weights=data["item_price"].to_numpy(), minlength=size
+            )
+            price_count = np.bincount(cell_codes, minlength=size)
+            item_price = np.divide(
+                price_sum,
+                price_count,
+                out=np.zeros(size),
+                where=price_count > 0,
+            ).astype(cls.dtype)
+        return cls(
+            # factorize widens the levels to int64, the index keeps the dtypes of the data
+            index.to_frame(index=False, name=cls.index_columns).astype(
+                data.dtypes[cls.index_columns].to_dict()
+            ),
+            item_cnt.reshape(n_rows, n_blocks),
+            item_price.reshape(n_rows, n_blocks),
+        )
+
+    def get_rows(self, start, stop):
+        """Returns the cube of the rows from start to stop, the matrices are views of this cube.
+        Rows are sorted by shop_id first, so the rows of a range of shops are contiguous.
+        """
+
+        rows = SalesCube(
+            self.index.iloc[start:stop].reset_index(drop=True),
+            self.item_cnt[start:stop],
+            self.item_price[start:stop],
+        )
+        rows._rolling_stats = {
+            clip_threshold: rolling_stats.get_rows(start, stop)
+            for clip_threshold, rolling_stats in self._rolling_stats.items()
+        }
+        return rows
+
+    def _get_blocks(self, values, start_block_num, end_block_num):
+        block_nums = list(range(start_block_num, end_block_num + 1))
+        return pd.DataFrame(
+            values[:, start_block_num : end_block_num + 1], columns=block_nums
+        )
+
+    def get_item_cnt(self, start_block_num, end_block_num):
+        """Returns item count columns of the blocks from start to end inclusive."""
+
+        return self._get_blocks(self.item_cnt, start_block_num, end_block_num)
+
+    def get_item_price(self, start_block_num, end_block_num):
+        """Returns item price columns of the blocks from start to end inclusive."""
+
+        return self._get_blocks(self.item_price, start_block_num, end_block_num)
+
+    def get_rolling_stats(self, clip_threshold):
+        """Returns the rolling statistics of the item count clipped to clip_threshold, built once per cube."""
+
+        if clip_threshold not in self._rolling_stats:
+            self._rolling_stats[clip_threshold] = RollingStats.from_counts(
+                self.item_cnt, clip_threshold
+            )
+        return self._rolling_stats[clip_threshold]
+
+    def get_rollup(self, clip_threshold):
+        """Returns the rollup cube of the item count clipped to clip_threshold, built once per cube.
+        Its levels are aggregated on their first use and kept for the next windows.
+        """
+
+        if clip_threshold not in self._rollups:
+            self._rollups[clip_threshold] = RollupCube(self, clip_threshold)
+        return self._rollups[clip_threshold]
+
+    def save(self, path):
+        """Saves the cube to a directory of .npy files.
+        Text columns of the index are stored as integer codes and their categories,
+        so that every file can be memory-mapped without pickling.
+        """
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "item_cnt.npy"), self.item_cnt)
+        np.save(os.path.join(path, "item_price.npy"), self.item_price)
+        for col in self.index_columns:
+            values = self.index[col]
+            if values.dtype == object:
+                codes, categories = pd.factorize(values)
+                np.save(os.path.join(path, f"{col}.codes.npy"), codes)
+                np.save(
+                    os.path.join(path, f"{col}.categories.npy"),
+                    categories.to_numpy(dtype=str),
+                )
+            else:
+                np.save(os.path.join(path, f"{col}.npy"), values.to_numpy())
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """Loads the cube saved by save, optionally memory-mapped."""
+
+        index = {}
+        for col in cls.index_columns:
+            col_path = os.path.join(path, f"{col}.npy")
+            if os.path.exists(col_path):
+                index[col] = np.load(col_path, mmap_mode=mmap_mode)
+            else:
+                codes = np.load(os.path.join(path, f"{col}.codes.npy"))
+                categories = np.load(os.path.join(path, f"{col}.categories.npy"))
+                index[col] = categories.astype(object)[codes]
+        return cls(
+            pd.DataFrame(index),
+            np.load(os.path.join(path, "item_cnt.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, "item_price.npy"), mmap_mode=mmap_mode),
+        )
@@ -0,0 +1,238 @@
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import config
+from src.data.category_encoder import CategoryEncoder
+from src.data.schema import DATA_DTYPES, RAW_DTYPES
+from src.features.build_features import FeatureEngineering
+from src.features.sales_cube import SalesCube
+from src.tracing import save_trace, traced, tracer
+from utils import get_data, load_data
+import click
+import joblib
+import numpy as np
+import pandas as pd
+
+
+@click.command()
+@click.argument("output_path", type=click.Path())
+@click.option(
+    "--test-path",
+    default=config.test_path,
+    type=click.Path(exists=True),
+    help="Pairs to score with the ID, shop_id and item_id columns of test.csv.",
+)
+@click.option(
+    "--x-test",
+    "x_test_path",
+    default=None,
+    type=click.Path(exists=True),
+    help="X_test saved by prepare_datasets, used instead of computing the features.",
+)
+@click.option(
+    "--prepared-data",
+    "prepared_data_path",
+    default=config.prepared_data_path,
+    type=click.Path(),
+    help="Prepared data the features of the test month are computed from.",
+)
+@click.option(
+    "--model-path",
+    default=config.xgb_model_save_path,
+    type=click.Path(exists=True),
+    help="Model saved by train_model.",
+)
+@click.option(
+    "--encodings-path",
+    default=config.category_encodings_path,
+    type=click.Path(),
+    help="Category codes saved by the ELT stage.",
+)
+@click.option(
+    "--batch-size", default=100_000, type=int, help="Rows scored per model call."
+)
+@click.option(
+    "--trace",
+    default=None,
+    type=click.Path(),
+    help="Record every step and save a Chrome trace JSON file to this path.",
+)
+def main(
+    output_path,
+    test_path,
+    x_test_path,
+    prepared_data_path,
+    model_path,
+    encodings_path,
+    batch_size,
+    trace,
+):
+    if trace is not None:
+        tracer.enable()
+    predictor = Predictor(model_path, encodings_path, batch_size=batch_size)
+    test = load_data(test_path, RAW_DTYPES)
+
+    start = time.perf_counter()
+    if x_test_path is not None:
+        X_test = load_data(x_test_path)
+    else:
+        X_test = predictor.get_features(
+            load_data(prepared_data_path, DATA_DTYPES), test
+        )
+    features_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    submission = predictor.predict_pairs(X_test, test)
+    predict_time = time.perf_counter() - start
+
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    submission.to_csv(output_path, index=False)
+    print(
+        f"Features of {len(X_test)} rows in {features_time:.2f} s, "
+        f"{len(submission)} pairs scored in {predict_time:.2f} s "
+        f"({len(submission) / max(predict_time, 1e-9):,.0f} rows/s)"
+    )
+    if trace is not None:
+        save_trace(trace)
+
+
+class Predictor:
+    """Batch scoring of shop-item pairs with the trained model.
+    The model and the category codes are loaded once. The features of the test
+    month are computed for its window only, from the prepared data and the
+    pairs to score, instead of running prepare_datasets for every window. The
+    rolling statistics are computed if the model was trained with them.
+    Args:
+        model_path (str): Model saved by train_model.
+        encodings_path (str): Category codes saved by the ELT stage.
+        batch_size (int): Rows scored per model call.
+        clip_threshold (int): Predictions are clipped to [0, clip_threshold] as the target.
+    Attributes:
+        model (Booster): The trained model.
+        category_encoder (CategoryEncoder): The dictionary of stable codes of categorical features.
+        batch_size (int): Rows scored per model call.
+        clip_threshold (int): Predictions are clipped to [0, clip_threshold] as the target.
+        rolling_stats (bool): Whether the model was trained with the rolling statistics.
+        iteration_range (tuple): Trees used for the predictions, up to the best iteration of early stopping.
+    Methods:
+        get_features(prepared_data, pairs): Returns the features of the test month window.
+        predict(X): Returns the predictions of the rows.
+        predict_pairs(X, pairs): Returns the predictions of the pairs in the Kaggle format.
+    """
+
+    def __init__(
+        self,
+        model_path,
+        encodings_path,
+        batch_size=100_000,
+        clip_threshold=config.clip_threshold,
+    ):
+        """Initializes Predictor class with the provided parameters."""
+
+        self.model = joblib.load(model_path)
+        self.category_encoder = CategoryEncoder.load(encodings_path)
+        self.batch_size = batch_size
+        self.clip_threshold = clip_threshold
+        self.rolling_stats = "months_since_last_sale" in (
+            self.model.feature_names or []
+        )
+        # Models saved with every tree of early stopping are scored up to the best
+        # iteration, (0, 0) scores with all the trees
+        best_iteration = self.model.attr("best_iteration")
+        self.iteration_range = (
+            0,
+            0 if best_iteration is None else int(best_iteration) + 1,
+        )
+
+    @staticmethod
+    def _get_pair_index(shop_ids, item_ids):
+        # ELT adds the pairs of test.csv with their shop ids as they are, without the remapping of the sales
+        return pd.MultiIndex.from_arrays([np.asarray(shop_ids), np.asarray(item_ids)])
+
+    def _add_pairs(self, prepared_data, pairs):
+        # Adds the pairs missing from the test month as rows without sales, as ELT
+        # does with test.csv. Their attributes are taken from the prepared data,
+        # the pairs of unknown shops or items are left out and get no prediction
+        test_block_num = prepared_data["date_block_num"].max()
+        test_data = prepared_data[prepared_data["date_block_num"] == test_block_num]
+        pair_index = self._get_pair_index(pairs["shop_id"], pairs["item_id"]).unique()
+        existing = pd.MultiIndex.from_frame(test_data[["shop_id", "item_id"]])
+        pair_index = pair_index[~pair_index.isin(existing)]
+        if len(pair_index) == 0:
+            return prepared_data
+
+        items = prepared_data.drop_duplicates("item_id").set_index("item_id")
+        shops = prepared_data.drop_duplicates("shop_id").set_index("shop_id")
+        new_rows = pd.DataFrame(
+            {
+                "date_block_num": test_block_num,
+                "shop_id": pair_index.get_level_values(0),
+                "item_category_id": items["item_category_id"]
+                .reindex(pair_index.get_level_values(1))
+                .to_numpy(),
+                "item_id": pair_index.get_level_values(1),
+                "item_category_name": items["item_category_name"]
+                .reindex(pair_index.get_level_values(1))
+                .to_numpy(),
+                "shop_name": shops["shop_name"]
+                .reindex(pair_index.get_level_values(0))
+                .to_numpy(),
+                "item_price": 0.0,
+                "item_cnt": 0.0,
+            }
+        ).dropna()
+        new_rows = new_rows.astype(prepared_data.dtypes[new_rows.columns].to_dict())
+        return pd.concat([prepared_data, new_rows], ignore_index=True)
+
+    @traced
+    def get_features(self, prepared_data, pairs):
+        """Returns the features of the window ending in the test month of the prepared data.
+        The rows of the window are the pairs of the prepared data and the pairs to score.
+        """
+
+        data = self._add_pairs(prepared_data, pairs)
+        test_block_num = int(data["date_block_num"].max())
+        processor = FeatureEngineering(
+            start_block_num=test_block_num - 12,
+            end_block_num=test_block_num,
+            category_encoder=self.category_encoder,
+            rolling_stats=self.rolling_stats,
+        )
+        X_test, _ = get_data(processor.get_features(SalesCube.from_data(data)))
+        return X_test
+
+    @traced
+    def predict(self, X):
+        """Returns the predictions of the rows, scored in batches of batch_size rows."""
+
+        predictions = np.empty(len(X), dtype=np.float32)
+        for start in range(0, len(X), self.batch_size):
+            batch = X.iloc[start : start + self.batch_size]
+            predictions[start : start + len(batch)] = self.model.inplace_predict(
+                batch, iteration_range=self.iteration_range
+            )
+        return np.clip(predictions, 0, self.clip_threshold)
+
+    @traced
+    def predict_pairs(self, X, pairs):
+        """Returns the predictions of the pairs as the ID and item_cnt_month columns of the Kaggle submission.
+        Only the rows of the pairs are scored, pairs without features are predicted as 0.
+        """
+
+        positions = pd.MultiIndex.from_frame(X[["shop_id", "item_id"]]).get_indexer(
+            self._get_pair_index(pairs["shop_id"], pairs["item_id"])
+        )
+        found = positions >= 0
+        item_cnt_month = np.zeros(len(pairs), dtype=np.float32)
+        item_cnt_month[found] = self.predict(X.iloc[positions[found]])
+        return pd.DataFrame(
+            {"ID": pairs["ID"].to_numpy(), "item_cnt_month": item_cnt_month}
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,68 +1,427 @@
-# from src.features.build_features import FeatureEngineering
-# from utils import get_data, downcast
-import get_data, downcast
-import FeatureEngineering
+import os
+import sys
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import islice
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from src.data.category_encoder import CategoryEncoder
+from src.data.schema import DATA_DTYPES
+from src.data.sharded_dataset import ShardedDataset
+from src.features.build_features import FeatureEngineering
+from src.features.feature_cache import FeatureCache
+from src.features.partitioned_features import (
+    PartitionedFeatureEngineering,
+    get_shard_executor,
+)
+from src.features.sales_cube import SalesCube
+from src.tracing import save_trace, traced, tracer
+from utils import get_data, load_data, save_data
 import pandas as pd
-from sklearn.preprocessing import LabelEncoder
 import click
 
+# Sales cube, category codes, shard memory budget, feature cache and rolling statistics
+# flag of a worker process, loaded once by _init_worker
+_worker_cube = None
+_worker_encoder = None
+_worker_shard_memory_mb = None
+_worker_cache = None
+_worker_rolling_stats = False
 
-@click.command()
-@click.argument("input_filepath", type=click.Path(exists=True))
-@click.argument("output_filepaths", type=click.Path(), nargs=5)
-def prepare_datasets(input_filepath, output_filepaths):
-
-    prepared_data = pd.read_csv(input_filepath)
-    test_block_num = prepared_data["date_block_num"].max() + 1
-
-    label_encoder = LabelEncoder()
 
-    # Пустые списки для хранения данных
-    X_train_list = []
-    y_train_list = []
+def get_window(
+    sales_cube,
+    end_block_num,
+    category_encoder,
+    shard_memory_mb=None,
+    cache=None,
+    rolling_stats=False,
+    shard_executor=None,
+):
+    """Generates features and labels of the 12 month window ending in end_block_num.
+    With shard_memory_mb the features are generated in shards of shops within this memory,
+    in the workers of shard_executor if it is given and without the cache, otherwise the
+    feature blocks with unchanged inputs are taken from the cache.
+    With rolling_stats the rolling statistics of the item count are added.
+    """
 
-    # In the cycle we go through a window of 12 months
-    # with a step of 1 month and form parts of the dataset for subsequent cocatenation
-    for end_block_num in range(test_block_num, -1, -1):
-        if end_block_num - 12 >= 0:
-            start_block_num = end_block_num - 12
+    with tracer.step("window", attributes={"end_block_num": end_block_num}):
+        if shard_memory_mb is None:
             processor = FeatureEngineering(
-                start_block_num=start_block_num,
+                start_block_num=end_block_num - 12,
                 end_block_num=end_block_num,
-                label_encoder=label_encoder,
+                category_encoder=category_encoder,
                 # clip_threshold=clip_threshold,
+                cache=cache,
+                rolling_stats=rolling_stats,
             )
-            train_data = processor.get_features(prepared_data)
+            train_data = processor.get_features(sales_cube)
+            # get_data casts the features to the dtypes of src.data.schema.DATASET_DTYPES
             X_train, y_train = get_data(train_data)
-            X_train_list.append(downcast(X_train))
-            y_train_list.append(y_train)
+        else:
+            processor = PartitionedFeatureEngineering(
+                start_block_num=end_block_num - 12,
+                end_block_num=end_block_num,
+                category_encoder=category_encoder,
+                memory_budget_mb=shard_memory_mb,
+                executor=shard_executor,
+                rolling_stats=rolling_stats,
+            )
+            # Only the rounded features of the shards are kept
+            shards = [get_data(data) for data in processor.iter_features(sales_cube)]
+            X_train = pd.concat([X for X, _ in shards], ignore_index=True)
+            y_train = pd.concat([y for _, y in shards], ignore_index=True)
+        tracer.set_output(X_train)
+    return X_train, y_train
 
-    # We create a test dataset where end_block_num=test_block_num and  start_block_num=end_block_num - 12
-    X_test = X_train_list[0]
-    # y_test = y_train_list[0]
 
-    # We create a test dataset where end_block_num=(test_block_num - 1)  and  start_block_num=(end_block_num - 12 -1)
-    X_val = pd.concat(
-        [X_train_list[1], X_train_list[len(X_train_list) - 1]], ignore_index=True
+def _init_worker(cube_path, encodings_path, shard_memory_mb, cache, rolling_stats):
+    global _worker_cube, _worker_encoder, _worker_shard_memory_mb, _worker_cache
+    global _worker_rolling_stats
+    # Steps of the workers are not recorded, the parent traces the windows as a whole
+    tracer.disable()
+    _worker_cube = SalesCube.load(cube_path, mmap_mode="r")
+    _worker_encoder = CategoryEncoder.load(encodings_path)
+    _worker_shard_memory_mb = shard_memory_mb
+    _worker_cache = cache
+    _worker_rolling_stats = rolling_stats
+
+
+def _get_worker_window(end_block_num):
+    return get_window(
+        _worker_cube,
+        end_block_num,
+        _worker_encoder,
+        _worker_shard_memory_mb,
+        _worker_cache,
+        _worker_rolling_stats,
+    )
+
+
+def iter_windows(
+    sales_cube,
+    end_block_nums,
+    encodings_path,
+    jobs=1,
+    shard_memory_mb=None,
+    cache=None,
+    rolling_stats=False,
+    shard_jobs=1,
+    cube_path=None,
+):
+    """Yields the windows ending in end_block_nums, in the same order, with jobs worker processes.
+    With shard_memory_mb the shards of every window are generated by shard_jobs worker processes
+    instead. Workers memory-map the cube saved in cube_path, by default it is saved once in a
+    temporary directory.
+    """
+
+    if jobs > 1 and shard_jobs > 1:
+        raise ValueError(
+            "Windows and shards can not both be generated in worker processes"
+        )
+    if shard_jobs > 1 and shard_memory_mb is None:
+        raise ValueError("Shard worker processes need shard_memory_mb")
+    if cache is not None and shard_memory_mb is not None:
+        raise ValueError("The feature cache is not used with shard_memory_mb")
+    if (jobs > 1 or shard_jobs > 1) and cube_path is None:
+        # Workers memory-map the cube instead of receiving a copy per task
+        with tempfile.TemporaryDirectory() as cube_path:
+            sales_cube.save(cube_path)
+            yield from iter_windows(
+                sales_cube,
+                end_block_nums,
+                encodings_path,
+                jobs,
+                shard_memory_mb,
+                cache,
+                rolling_stats,
+                shard_jobs,
+                cube_path,
+            )
+        return
+    if jobs > 1:
+        # At most jobs windows are in flight, a window is submitted when the oldest
+        # one is consumed, so finished windows do not pile up in memory
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_worker,
+            initargs=(
+                cube_path,
+                encodings_path,
+                shard_memory_mb,
+                cache,
+                rolling_stats,
+            ),
+        ) as executor:
+            end_block_nums = iter(end_block_nums)
+            futures = deque(
+                executor.submit(_get_worker_window, end_block_num)
+                for end_block_num in islice(end_block_nums, jobs)
+            )
+            while futures:
+                window = futures.popleft().result()
+                end_block_num = next(end_block_nums, None)
+                if end_block_num is not None:
+                    futures.append(executor.submit(_get_worker_window, end_block_num))
+                yield window
+                del window
+        return
+    category_encoder = CategoryEncoder.load(encodings_path)
+    # The shard workers are started once for all the windows
+    with (
+        get_shard_executor(cube_path, shard_jobs) if shard_jobs > 1 else nullcontext()
+    ) as shard_executor:
+        for end_block_num in end_block_nums:
+            yield get_window(
+                sales_cube,
+                end_block_num,
+                category_encoder,
+                shard_memory_mb,
+                cache,
+                rolling_stats,
+                shard_executor,
+            )
+
+
+def get_splits(end_block_nums):
+    """Returns the windows of the test, validation and train splits from the windows ordered by decreasing end_block_num."""
+
+    return {
+        # We create a test dataset where end_block_num=test_block_num and  start_block_num=end_block_num - 12
+        "test": end_block_nums[:1],
+        # We create a test dataset where end_block_num=(test_block_num - 1)  and  start_block_num=(end_block_num - 12 -1)
+        "val": [end_block_nums[1], end_block_nums[-1]],
+        # Form a training dataset by concatenating all subsequent parts of the dataset
+        "train": end_block_nums[2:],
+    }
+
+
+@traced
+def assemble_datasets(X_train_list, y_train_list):
+    """Forms the train, validation and test datasets from the windows ordered by decreasing end_block_num."""
+
+    positions = get_splits(list(range(len(X_train_list))))
+    X_test = X_train_list[positions["test"][0]]
+    # y_test = y_train_list[0]
+    # Every dataset is concatenated once, so the copying is linear in its size
+    X_val = pd.concat([X_train_list[i] for i in positions["val"]], ignore_index=True)
+    y_val = pd.concat([y_train_list[i] for i in positions["val"]], ignore_index=True)
+    X_train = pd.concat(
+        [X_train_list[i] for i in positions["train"]], ignore_index=True
     )
-    y_val = pd.concat(
-        [y_train_list[1], y_train_list[len(y_train_list) - 1]], ignore_index=True
+    y_train = pd.concat(
+        [y_train_list[i] for i in positions["train"]], ignore_index=True
     )
+    return X_train, y_train, X_val, y_val, X_test
+
+
+@click.command()
+@click.argument("input_filepath", type=click.Path(exists=True))
+@click.argument("output_filepaths", type=click.Path(), nargs=5)
+@click.option(
+    "--jobs",
+    default=1,
+    type=int,
+    help="Number of worker processes generating the windows.",
+)
+@click.option(
+    "--encodings-path",
+    default="./models/category_encodings.json",
+    type=click.Path(exists=True),
+    help="Category codes saved by the ELT stage.",
+)
+@click.option(
+    "--shard-memory-mb",
+    default=None,
+    type=float,
+    help="Generate every window in shards of shops within about this much memory.",
+)
+@click.option(
+    "--shard-jobs",
+    default=1,
+    type=int,
+    help="Number of worker processes generating the shards of every window, with --shard-memory-mb.",
+)
+@click.option(
+    "--cube-dir",
+    default=None,
+    type=click.Path(),
+    help="Save the sales cube to this directory and memory-map it, it can be the input of later runs.",
+)
+@click.option(
+    "--cache-dir",
+    default=None,
+    type=click.Path(),
+    help="Directory caching the feature blocks of the windows between runs, not with --shard-memory-mb.",
+)
+@click.option(
+    "--cache-size-mb",
+    default=2048,
+    type=float,
+    help="Maximum size of --cache-dir, the least recently used blocks are removed.",
+)
+@click.option(
+    "--rolling-stats",
+    is_flag=True,
+    help="Add the rolling means, deviations and slopes of the item count and the months since the first and last sale.",
+)
+@click.option(
+    "--shard-dir",
+    default=None,
+    type=click.Path(),
+    help="Write every window to this sharded dataset as it is generated and save the outputs from it.",
+)
+@click.option(
+    "--state-dir",
+    default=None,
+    type=click.Path(),
+    help="Directory keeping the windows for incremental refreshes.",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Generate only the new test and validation windows, take the others from --state-dir.",
+)
+@click.option(
+    "--trace",
+    default=None,
+    type=click.Path(),
+    help="Record every step and save a Chrome trace JSON file to this path.",
+)
+def prepare_datasets(
+    input_filepath,
+    output_filepaths,
+    jobs,
+    encodings_path,
+    shard_memory_mb,
+    shard_jobs,
+    cube_dir,
+    cache_dir,
+    cache_size_mb,
+    rolling_stats,
+    shard_dir,
+    state_dir,
+    refresh,
+    trace,
+):
+    if refresh and state_dir is None:
+        raise click.UsageError("--refresh requires --state-dir")
+    if shard_jobs > 1 and shard_memory_mb is None:
+        raise click.UsageError("--shard-jobs requires --shard-memory-mb")
+    if shard_jobs > 1 and jobs > 1:
+        raise click.UsageError("--shard-jobs and --jobs can not be used together")
+    if cache_dir is not None and shard_memory_mb is not None:
+        raise click.UsageError("--cache-dir can not be used with --shard-memory-mb")
+    if trace is not None:
+        tracer.enable()
 
-    # Form a training dataset by concatenating all subsequent parts of the dataset
-    X_train = X_train_list[2]
-    y_train = y_train_list[2]
+    cube_path = cube_dir
+    if os.path.isdir(input_filepath):
+        # A cube saved by --cube-dir is memory-mapped without reading the prepared data
+        cube_path = input_filepath
+        sales_cube = SalesCube.load(cube_path, mmap_mode="r")
+    else:
+        with tracer.step("load_data"):
+            prepared_data = load_data(input_filepath, DATA_DTYPES)
+            tracer.set_output(prepared_data)
 
-    for i in range(3, len(X_train_list)):
-        X_train = pd.concat([X_train, X_train_list[i]], ignore_index=True)
-        y_train = pd.concat([y_train, y_train_list[i]], ignore_index=True)
+        # The shop-item by month cube is built once and every window is sliced from it
+        with tracer.step("SalesCube.from_data", [prepared_data]):
+            sales_cube = SalesCube.from_data(prepared_data)
+        del prepared_data
+        if cube_path is None and shard_memory_mb is not None:
+            # Shards only read their rows of a memory-mapped cube, the temporary
+            # directory is removed when the run exits
+            cube_tmp_dir = tempfile.TemporaryDirectory()
+            cube_path = cube_tmp_dir.name
+        if cube_path is not None:
+            # The cube in memory is replaced with the saved one, also read by the workers
+            with tracer.step("SalesCube.save"):
+                sales_cube.save(cube_path)
+                sales_cube = SalesCube.load(cube_path, mmap_mode="r")
+    # The prepared data already contains the test month as its last block
+    test_block_num = sales_cube.n_blocks - 1
+
+    # In the cycle we go through a window of 12 months
+    # with a step of 1 month and form parts of the dataset for subsequent cocatenation
+    end_block_nums = [
+        end_block_num
+        for end_block_num in range(test_block_num, -1, -1)
+        if end_block_num - 12 >= 0
+    ]
+    state = None if state_dir is None else ShardedDataset(state_dir)
+    # In the sharded mode the windows are not kept in memory but written to the dataset
+    dataset = None if shard_dir is None else ShardedDataset(shard_dir)
+    windows = {}
+
+    def add_window(end_block_num, window):
+        if dataset is None:
+            windows[end_block_num] = window
+        elif state is None or os.path.abspath(state.path) != os.path.abspath(
+            dataset.path
+        ):
+            dataset.write_window(end_block_num, *window)
+
+    new_block_nums = end_block_nums
+    if refresh:
+        # Windows ending before the new month keep the rows and features of the run
+        # that generated them, only the new test and validation windows are generated
+        new_block_nums = []
+        for end_block_num in end_block_nums:
+            window = None
+            if end_block_num < test_block_num - 1:
+                window = state.read_window(end_block_num)
+            if window is None:
+                new_block_nums.append(end_block_num)
+            else:
+                add_window(end_block_num, window)
+    new_windows = iter_windows(
+        sales_cube,
+        new_block_nums,
+        encodings_path,
+        jobs,
+        shard_memory_mb,
+        None if cache_dir is None else FeatureCache(cache_dir, cache_size_mb),
+        rolling_stats,
+        shard_jobs,
+        cube_path,
+    )
+    with tracer.step("windows"):
+        for end_block_num, window in zip(new_block_nums, new_windows):
+            if state is not None:
+                state.write_window(end_block_num, *window)
+            add_window(end_block_num, window)
+
+    if dataset is not None:
+        # Splits are saved window by window from the shards
+        dataset.write_manifest(get_splits(end_block_nums))
+        with tracer.step("save_data"):
+            dataset.save_split("train", output_filepaths[0], output_filepaths[1])
+            dataset.save_split("val", output_filepaths[2], output_filepaths[3])
+            dataset.save_split("test", output_filepaths[4])
+        if trace is not None:
+            save_trace(trace)
+        return
+
+    X_train_list = [windows[end_block_num][0] for end_block_num in end_block_nums]
+    y_train_list = [windows[end_block_num][1] for end_block_num in end_block_nums]
+    del windows
+
+    X_train, y_train, X_val, y_val, X_test = assemble_datasets(
+        X_train_list, y_train_list
+    )
 
-    # Save all the  datasets to the specified path
-    X_train.to_csv(output_filepaths[0], index=False)
-    y_train.to_csv(output_filepaths[1], index=False)
-    X_val.to_csv(output_filepaths[2], index=False)
-    y_val.to_csv(output_filepaths[3], index=False)
-    X_test.to_csv(output_filepaths[4], index=False)
+    # Save all the  datasets to the specified path, the format is given by the extension
+    with tracer.step("save_data", [X_train]):
+        save_data(X_train, output_filepaths[0])
+        save_data(y_train, output_filepaths[1])
+        save_data(X_val, output_filepaths[2])
+        save_data(y_val, output_filepaths[3])
+        save_data(X_test, output_filepaths[4])
+    if trace is not None:
+        save_trace(trace)
 
 
 if __name__ == "__main__":
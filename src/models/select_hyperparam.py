@@ -0,0 +1,376 @@
+import math
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import config
+from src.models.train_model import ModelTrainer, WindowSource
+from src.tracing import save_trace, traced, tracer
+from utils import save_data
+import click
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import ParameterSampler
+
+
+@click.command()
+@click.argument("input_path", type=click.Path(exists=True))
+@click.option(
+    "--model-path",
+    default=config.best_grid_model_save_path,
+    type=click.Path(),
+    help="Path of the model trained with the best parameters.",
+)
+@click.option(
+    "--log-path",
+    default=config.hyperparam_log_path,
+    type=click.Path(),
+    help="Path of the log of every trial, the format is given by the extension.",
+)
+@click.option(
+    "--encodings-path",
+    default=config.category_encodings_path,
+    type=click.Path(),
+    help="Category codes saved by the ELT stage, used with the prepared data.",
+)
+@click.option(
+    "--cache-dir",
+    default=None,
+    type=click.Path(),
+    help="Feature cache of the windows generated from the prepared data.",
+)
+@click.option(
+    "--rolling-stats",
+    is_flag=True,
+    help="Add the rolling statistics of the item count to the windows generated from the prepared data.",
+)
+@click.option("--n-folds", default=3, type=int, help="Time-ordered folds.")
+@click.option(
+    "--n-configs", default=27, type=int, help="Parameter sets of successive halving."
+)
+@click.option(
+    "--min-rounds", default=25, type=int, help="Boosting rounds of the first rung."
+)
+@click.option(
+    "--max-rounds", default=300, type=int, help="Boosting rounds of the last rung."
+)
+@click.option(
+    "--reduction-factor",
+    default=3,
+    type=int,
+    help="A rung keeps 1/reduction_factor of the parameter sets with reduction_factor times the rounds.",
+)
+@click.option(
+    "--hyperband",
+    is_flag=True,
+    help="Run the brackets of Hyperband instead of a single successive halving.",
+)
+@click.option("--jobs", default=1, type=int, help="Number of threads running trials.")
+@click.option("--max-bin", default=256, type=int, help="Histogram bins per feature.")
+@click.option("--seed", default=0, type=int, help="Seed of the parameter sampling.")
+@click.option(
+    "--trace",
+    default=None,
+    type=click.Path(),
+    help="Record every step and save a Chrome trace JSON file to this path.",
+)
+def main(
+    input_path,
+    model_path,
+    log_path,
+    encodings_path,
+    cache_dir,
+    rolling_stats,
+    n_folds,
+    n_configs,
+    min_rounds,
+    max_rounds,
+    reduction_factor,
+    hyperband,
+    jobs,
+    max_bin,
+    seed,
+    trace,
+):
+    if trace is not None:
+        tracer.enable()
+    source = WindowSource(input_path, encodings_path, cache_dir, rolling_stats)
+    search = HyperparamSearch(
+        n_folds=n_folds,
+        n_configs=n_configs,
+        min_rounds=min_rounds,
+        max_rounds=max_rounds,
+        reduction_factor=reduction_factor,
+        hyperband=hyperband,
+        jobs=jobs,
+        max_bin=max_bin,
+        seed=seed,
+    )
+    trials = search.run(source)
+    save_data(trials, log_path)
+
+    best_params = search.get_best_params(trials)
+    best_rounds = search.get_best_rounds(trials)
+    print(f"Best parameters: {best_params}, rounds: {best_rounds}")
+    # The final model is trained for the rounds chosen on the time-ordered folds,
+    # its validation split is only reported and does not stop the training
+    trainer = ModelTrainer(
+        num_boost_round=best_rounds,
+        early_stopping_rounds=None,
+        max_bin=max_bin,
+        params=best_params,
+    )
+    model = trainer.train(source)
+    trainer.save(model, model_path)
+    if trace is not None:
+        save_trace(trace)
+
+
+class HyperparamSearch:
+    """Successive halving search of the XGBoost parameters over time-ordered folds.
+    A fold validates on one window of the train split and trains on the windows
+    that end before it, so no trial sees the future of its validation month.
+    Parameter sets sampled from param_grid are trained for min_rounds on every
+    fold, the best 1/reduction_factor of them by the mean validation RMSE go on
+    with reduction_factor times the rounds, until max_rounds. With hyperband the
+    brackets of Hyperband, from many sets with few rounds to few sets with
+    max_rounds, are run one after the other. The QuantileDMatrix of every fold is
+    built once and shared by all the trials, which run in jobs threads with the
+    cores of the machine split between them, XGBoost releases the GIL while training.
+    Args:
+        param_grid (dict): Values of every searched booster parameter, the grid of the search.
+        n_folds (int): Time-ordered folds.
+        n_configs (int): Parameter sets of successive halving.
+        min_rounds (int): Boosting rounds of the first rung.
+        max_rounds (int): Boosting rounds of the last rung.
+        reduction_factor (int): A rung keeps 1/reduction_factor of the sets with reduction_factor times the rounds.
+        hyperband (bool): Whether to run the brackets of Hyperband instead of a single successive halving.
+        jobs (int): Number of threads running trials.
+        max_bin (int): Histogram bins per feature, shared by the matrices of all trials.
+        early_stopping_rounds (int): Stop a trial when the validation RMSE has not improved for this many rounds.
+        seed (int): Seed of the parameter sampling and of the boosters.
+    Attributes:
+        default_param_grid (dict): Grid searched when param_grid is not given.
+    Methods:
+        get_folds(end_block_nums): Returns the training and validation windows of the folds.
+        get_brackets(): Returns the number of parameter sets and the first rounds of every bracket.
+        run(source): Runs the search and returns the log of the trials.
+        get_best_params(trials): Returns the parameters with the lowest mean validation RMSE.
+        get_best_rounds(trials): Returns the boosting rounds of the best trial found in the folds.
+    """
+
+    default_param_grid = {
+        "max_depth": [4, 6, 8, 10],
+        "eta": [0.03, 0.1, 0.3],
+        "subsample": [0.6, 0.8, 1.0],
+        "colsample_bytree": [0.6, 0.8, 1.0],
+        "min_child_weight": [1, 5, 20],
+        "lambda": [1, 5, 20],
+    }
+
+    def __init__(
+        self,
+        param_grid=None,
+        n_folds=3,
+        n_configs=27,
+        min_rounds=25,
+        max_rounds=300,
+        reduction_factor=3,
+        hyperband=False,
+        jobs=1,
+        max_bin=256,
+        early_stopping_rounds=20,
+        seed=0,
+    ):
+        """Initializes HyperparamSearch class with the provided parameters."""
+
+        self.param_grid = self.default_param_grid if param_grid is None else param_grid
+        self.n_folds = n_folds
+        self.n_configs = n_configs
+        self.min_rounds = min_rounds
+        self.max_rounds = max_rounds
+        self.reduction_factor = reduction_factor
+        self.hyperband = hyperband
+        self.jobs = jobs
+        self.max_bin = max_bin
+        self.early_stopping_rounds = early_stopping_rounds
+        self.seed = seed
+
+    def get_folds(self, end_block_nums):
+        """Returns the training and validation windows of the folds, latest validation window first.
+        The windows are the ones of the train split, ordered by decreasing end_block_num.
+        """
+
+        if len(end_block_nums) <= self.n_folds:
+            raise ValueError(
+                f"{len(end_block_nums)} windows are too few for {self.n_folds} folds"
+            )
+        return [
+            (list(end_block_nums[i + 1 :]), [end_block_nums[i]])
+            for i in range(self.n_folds)
+        ]
+
+    def get_brackets(self):
+        """Returns the number of parameter sets and the first rounds of every bracket."""
+
+        if not self.hyperband:
+            return [(self.n_configs, self.min_rounds)]
+        # Hyperband with the rounds counted in units of min_rounds
+        max_units = self.max_rounds / self.min_rounds
+        s_max = int(math.log(max_units, self.reduction_factor) + 1e-9)
+        brackets = []
+        for s in range(s_max, -1, -1):
+            n_configs = math.ceil((s_max + 1) / (s + 1) * self.reduction_factor**s)
+            rounds = max(round(self.max_rounds / self.reduction_factor**s), 1)
+            brackets.append((n_configs, rounds))
+        return brackets
+
+    @traced
+    def run(self, source):
+        """Runs the search on the windows of the WindowSource and returns the log of the trials,
+        one row per trial, rung and fold.
+        """
+
+        folds = self.get_folds(source.splits["train"])
+        trainer = ModelTrainer(max_bin=self.max_bin)
+        matrices = [
+            trainer.get_matrices(source, train_block_nums, val_block_nums)
+            for train_block_nums, val_block_nums in folds
+        ]
+        n_configs = sum(n_configs for n_configs, _ in self.get_brackets())
+        sampler = ParameterSampler(
+            self.param_grid, n_iter=n_configs, random_state=self.seed
+        )
+        configs = iter(list(sampler))
+        nthread = max((os.cpu_count() or 1) // self.jobs, 1)
+        run_trial = partial(_run_trial, matrices, self.max_bin)
+
+        if self.jobs > 1:
+            executor = ThreadPoolExecutor(max_workers=self.jobs)
+            run_tasks = executor.map
+        else:
+            executor = None
+            run_tasks = map
+        log = []
+        trial = 0
+        try:
+            for bracket, (n_configs, rounds) in enumerate(self.get_brackets()):
+                trials = {}
+                for _ in range(n_configs):
+                    params = next(configs, None)
+                    if params is None:
+                        break
+                    trials[trial] = {**params, "seed": self.seed, "nthread": nthread}
+                    trial += 1
+                rung = 0
+                while trials:
+                    with tracer.step(
+                        "rung",
+                        attributes={
+                            "bracket": bracket,
+                            "rung": rung,
+                            "trials": len(trials),
+                            "rounds": rounds,
+                        },
+                    ):
+                        tasks = [
+                            (params, rounds, self.early_stopping_rounds, fold)
+                            for params in trials.values()
+                            for fold in range(len(folds))
+                        ]
+                        results = list(run_tasks(run_trial, tasks))
+                    keys = [
+                        (trial_id, fold)
+                        for trial_id in trials
+                        for fold in range(len(folds))
+                    ]
+                    for (trial_id, fold), result in zip(keys, results):
+                        params = {
+                            key: value
+                            for key, value in trials[trial_id].items()
+                            if key != "nthread"
+                        }
+                        log.append(
+                            {
+                                "bracket": bracket,
+                                "rung": rung,
+                                "trial": trial_id,
+                                "fold": fold,
+                                "rounds": rounds,
+                                **params,
+                                **result,
+                            }
+                        )
+                    if rounds >= self.max_rounds:
+                        break
+                    # The best trials of the rung by the mean RMSE of their folds go on
+                    scores = pd.DataFrame(log[-len(keys) :]).groupby("trial")["rmse"]
+                    n_kept = len(trials) // self.reduction_factor
+                    if n_kept == 0:
+                        break
+                    kept = scores.mean().nsmallest(n_kept).index
+                    trials = {trial_id: trials[trial_id] for trial_id in kept}
+                    rounds = min(rounds * self.reduction_factor, self.max_rounds)
+                    rung += 1
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return pd.DataFrame(log)
+
+    def _get_best_trial(self, trials):
+        # Rows of the folds of the trial and rung with the lowest mean validation RMSE
+        scores = trials.groupby(["bracket", "rung", "trial"])["rmse"].mean()
+        bracket, rung, trial = scores.idxmin()
+        return (
+            (trials["bracket"] == bracket)
+            & (trials["rung"] == rung)
+            & (trials["trial"] == trial)
+        )
+
+    def get_best_params(self, trials):
+        """Returns the parameters of the trial and rung with the lowest mean validation RMSE."""
+
+        params = [
+            col for col in trials.columns if col in self.param_grid or col == "seed"
+        ]
+        # Values are read column by column, a row would cast the integers to floats
+        row = self._get_best_trial(trials).idxmax()
+        return {col: _to_python(trials.at[row, col]) for col in params}
+
+    def get_best_rounds(self, trials):
+        """Returns the boosting rounds of the best trial, the mean of the best rounds of its folds."""
+
+        best_iterations = trials.loc[self._get_best_trial(trials), "best_iteration"]
+        return max(int(round(best_iterations.mean())) + 1, 1)
+
+
+def _to_python(value):
+    # Parameters read back from the log are numpy scalars
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _run_trial(matrices, max_bin, task):
+    # Trains a parameter set on the shared matrices of a fold
+    params, rounds, early_stopping_rounds, fold = task
+    dtrain, dval = matrices[fold]
+    start = time.perf_counter()
+    trainer = ModelTrainer(
+        num_boost_round=rounds,
+        early_stopping_rounds=early_stopping_rounds,
+        max_bin=max_bin,
+        params=params,
+        verbose_eval=False,
+    )
+    model = trainer.fit(dtrain, dval)
+    return {
+        "rmse": model.best_score,
+        "best_iteration": model.best_iteration,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import config
+from src.data.schema import DATA_DTYPES
+from src.data.sharded_dataset import ShardedDataset
+from src.features.feature_cache import FeatureCache
+from src.features.sales_cube import SalesCube
+from src.models.prepare_datasets import get_splits, iter_windows
+from src.tracing import save_trace, traced, tracer
+from utils import load_data
+import click
+import joblib
+import xgboost as xgb
+
+
+@click.command()
+@click.argument("input_path", type=click.Path(exists=True))
+@click.option(
+    "--model-path",
+    default=config.xgb_model_save_path,
+    type=click.Path(),
+    help="Path of the trained model.",
+)
+@click.option(
+    "--encodings-path",
+    default=config.category_encodings_path,
+    type=click.Path(),
+    help="Category codes saved by the ELT stage, used with the prepared data.",
+)
+@click.option(
+    "--cache-dir",
+    default=None,
+    type=click.Path(),
+    help="Feature cache of the windows, saves the second pass over the prepared data.",
+)
+@click.option(
+    "--rolling-stats",
+    is_flag=True,
+    help="Add the rolling statistics of the item count to the windows generated from the prepared data.",
+)
+@click.option(
+    "--external-memory",
+    "cache_prefix",
+    default=None,
+    type=click.Path(),
+    help="Keep the training pages on disk with this cache prefix instead of in a QuantileDMatrix.",
+)
+@click.option("--num-boost-round", default=300, type=int, help="Boosting rounds.")
+@click.option(
+    "--early-stopping-rounds",
+    default=20,
+    type=int,
+    help="Stop when the validation RMSE has not improved for this many rounds.",
+)
+@click.option("--max-bin", default=256, type=int, help="Histogram bins per feature.")
+@click.option(
+    "--trace",
+    default=None,
+    type=click.Path(),
+    help="Record every step and save a Chrome trace JSON file to this path.",
+)
+def main(
+    input_path,
+    model_path,
+    encodings_path,
+    cache_dir,
+    rolling_stats,
+    cache_prefix,
+    num_boost_round,
+    early_stopping_rounds,
+    max_bin,
+    trace,
+):
+    if trace is not None:
+        tracer.enable()
+    source = WindowSource(input_path, encodings_path, cache_dir, rolling_stats)
+    trainer = ModelTrainer(
+        num_boost_round=num_boost_round,
+        early_stopping_rounds=early_stopping_rounds,
+        max_bin=max_bin,
+        cache_prefix=cache_prefix,
+    )
+    model = trainer.train(source)
+    trainer.save(model, model_path)
+    if trace is not None:
+        save_trace(trace)
+
+
+class WindowSource:
+    """Windows of the train and validation splits, read lazily one at a time.
+    The input is either a sharded dataset written by prepare_datasets --shard-dir
+    or the prepared data, whose windows are generated by the feature pipeline
+    when they are read.
+    Args:
+        input_path (str): Directory of a sharded dataset or path of the prepared data.
+        encodings_path (str): Category codes saved by the ELT stage, used with the prepared data.
+        cache_dir (str): Feature cache of the windows generated from the prepared data.
+        rolling_stats (bool): Whether the windows generated from the prepared data get the rolling statistics.
+    Attributes:
+        splits (dict): Windows of every split by their end_block_num.
+    Methods:
+        iter_windows(end_block_nums): Yields the features and labels of the windows.
+        iter_split(split): Yields the features and labels of the windows of a split.
+    """
+
+    def __init__(
+        self, input_path, encodings_path=None, cache_dir=None, rolling_stats=False
+    ):
+        """Initializes WindowSource class with the provided parameters."""
+
+        self.input_path = input_path
+        self.encodings_path = encodings_path
+        self.cache = None if cache_dir is None else FeatureCache(cache_dir)
+        self.rolling_stats = rolling_stats
+        if os.path.isdir(input_path):
+            self._dataset = ShardedDataset(input_path)
+            self.splits = self._dataset.read_manifest()
+        else:
+            self._dataset = None
+            # The cube is the size of the prepared data, the windows are generated from it on demand
+            self._sales_cube = SalesCube.from_data(load_data(input_path, DATA_DTYPES))
+            test_block_num = self._sales_cube.n_blocks - 1
+            self.splits = get_splits(list(range(test_block_num, 11, -1)))
+
+    def iter_windows(self, end_block_nums):
+        """Yields the features and labels of the windows ending in end_block_nums, in the same order."""
+
+        if self._dataset is not None:
+            for end_block_num in end_block_nums:
+                window = self._dataset.read_window(end_block_num)
+                if window is None:
+                    raise FileNotFoundError(
+                        f"Window {end_block_num} is not in {self._dataset.path}"
+                    )
+                yield window
+            return
+        yield from iter_windows(
+            self._sales_cube,
+            end_block_nums,
+            self.encodings_path,
+            cache=self.cache,
+            rolling_stats=self.rolling_stats,
+        )
+
+    def iter_split(self, split):
+        """Yields the features and labels of the windows of a split."""
+
+        return self.iter_windows(self.splits[split])
+
+
+class WindowIter(xgb.DataIter):
+    """An xgboost data iterator over windows.
+    Every batch is one window, so XGBoost builds its matrix without the
+    concatenated windows ever being in memory.
+    Args:
+        source (WindowSource): Windows of the splits.
+        end_block_nums (list): Windows to iterate over.
+        cache_prefix (str): Prefix of the external memory pages, None to build a QuantileDMatrix.
+    """
+
+    def __init__(self, source, end_block_nums, cache_prefix=None):
+        """Initializes WindowIter class with the provided parameters."""
+
+        self.source = source
+        self.end_block_nums = end_block_nums
+        self._windows = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        """Passes the next window to XGBoost, returns 0 when the split is over."""
+
+        if self._windows is None:
+            self._windows = iter(self.source.iter_windows(self.end_block_nums))
+        window = next(self._windows, None)
+        if window is None:
+            return 0
+        X, y = window
+        input_data(data=X, label=y)
+        return 1
+
+    def reset(self):
+        """Starts the windows over, XGBoost reads them once per pass."""
+
+        self._windows = None
+
+
+class ModelTrainer:
+    """Training of the XGBoost model on the windows read lazily.
+    The training matrix is a QuantileDMatrix built batch by batch, which keeps
+    only the histogram bins of the data in memory, or an external memory DMatrix
+    with its pages on disk. The validation matrix uses the bins of the training one
+    and only windows disjoint from the training ones.
+    Args:
+        num_boost_round (int): Boosting rounds.
+        early_stopping_rounds (int): Stop when the validation RMSE has not improved for this many rounds, None to train every round.
+        max_bin (int): Histogram bins per feature.
+        cache_prefix (str): Prefix of the external memory pages, None to build a QuantileDMatrix.
+        params (dict): Booster parameters replacing the default ones.
+        verbose_eval (int): Rounds between the printed evaluations, False to print none.
+    Attributes:
+        params (dict): Booster parameters.
+    Methods:
+        get_matrices(source, train_block_nums, val_block_nums): Returns the training and validation matrices.
+        fit(dtrain, dval): Trains the model on the matrices.
+        train(source): Trains the model on the windows of the source.
+        save(model, path): Saves the model.
+    """
+
+    params = {
+        "objective": "reg:squarederror",
+        "eval_metric": "rmse",
+        "tree_method": "hist",
+        "max_depth": 8,
+        "eta": 0.1,
+        "subsample": 0.8,
+        "colsample_bytree": 0.8,
+        # All cores of the machine
+        "nthread": os.cpu_count(),
+    }
+
+    def __init__(
+        self,
+        num_boost_round=300,
+        early_stopping_rounds=20,
+        max_bin=256,
+        cache_prefix=None,
+        params=None,
+        verbose_eval=10,
+    ):
+        """Initializes ModelTrainer class with the provided parameters."""
+
+        self.num_boost_round = num_boost_round
+        self.early_stopping_rounds = early_stopping_rounds
+        self.max_bin = max_bin
+        self.cache_prefix = cache_prefix
+        self.params = {**self.params, **(params or {})}
+        self.verbose_eval = verbose_eval
+
+    @traced
+    def get_matrices(self, source, train_block_nums=None, val_block_nums=None):
+        """Returns the training and validation matrices built from the windows of the source,
+        the windows of the train and val splits by default. The val split of
+        prepare_datasets also holds the oldest train window, which is left out of the
+        validation matrix, so that early stopping is scored on unseen windows only.
+        """
+
+        if train_block_nums is None:
+            train_block_nums = source.splits["train"]
+        if val_block_nums is None:
+            val_block_nums = [
+                end_block_num
+                for end_block_num in source.splits["val"]
+                if end_block_num not in train_block_nums
+            ]
+        if self.cache_prefix is None:
+            dtrain = xgb.QuantileDMatrix(
+                WindowIter(source, train_block_nums), max_bin=self.max_bin
+            )
+        else:
+            # XGBoost writes the pages but does not create their directory
+            directory = os.path.dirname(self.cache_prefix)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            dtrain = xgb.DMatrix(
+                WindowIter(source, train_block_nums, self.cache_prefix)
+            )
+        dval = xgb.QuantileDMatrix(
+            WindowIter(source, val_block_nums), max_bin=self.max_bin, ref=dtrain
+        )
+        return dtrain, dval
+
+    def fit(self, dtrain, dval):
+        """Trains the model on the matrices with early stopping on the validation one.
+        An early-stopped model is cut to its best iteration, so the trees after it are not saved.
+        """
+
+        callbacks = []
+        if self.early_stopping_rounds is not None:
+            callbacks.append(
+                xgb.callback.EarlyStopping(
+                    rounds=self.early_stopping_rounds, save_best=True
+                )
+            )
+        return xgb.train(
+            {**self.params, "max_bin": self.max_bin},
+            dtrain,
+            num_boost_round=self.num_boost_round,
+            evals=[(dtrain, "train"), (dval, "val")],
+            callbacks=callbacks,
+            verbose_eval=self.verbose_eval,
+        )
+
+    @traced
+    def train(self, source):
+        """Trains the model on the windows of the source with early stopping on the validation split."""
+
+        return self.fit(*self.get_matrices(source))
+
+    def save(self, model, path):
+        """Saves the model with joblib, as the .pkl path of config.xgb_model_save_path."""
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        joblib.dump(model, path)
+
+
+if __name__ == "__main__":
+    main()
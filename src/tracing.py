@@ -0,0 +1,231 @@
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+class Tracer:
+    """Opt-in instrumentation of the pipeline steps.
+    When enabled, every traced step records its wall time, CPU time, peak memory
+    delta, the shape of its largest input and of its output and the output memory
+    usage. The peak memory is the resident set size of the process on Linux and
+    the tracemalloc peak elsewhere. Events are saved in the Chrome trace format
+    (chrome://tracing, Perfetto) and can be summarised as a table. When disabled,
+    a traced step costs a single check.
+    Attributes:
+        enabled (bool): Whether the steps are recorded.
+        events (list): Recorded events in the Chrome trace format.
+    Methods:
+        enable(): Starts recording the steps.
+        disable(): Stops recording the steps.
+        step(name, inputs, attributes): Context manager recording a step.
+        set_output(output): Records the output of the current step.
+        save(path): Saves the events as a Chrome trace JSON file.
+        get_summary(): Returns a table of the recorded steps aggregated by name.
+    """
+
+    def __init__(self):
+        """Initializes Tracer class."""
+
+        self.enabled = False
+        self.events = []
+        self._stack = []
+        self._start = time.perf_counter()
+        self._use_rss = False
+
+    def enable(self):
+        """Starts recording the steps."""
+
+        self.enabled = True
+        self.events = []
+        self._start = time.perf_counter()
+        self._use_rss = reset_peak_rss()
+        if not self._use_rss and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        """Stops recording the steps."""
+
+        self.enabled = False
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _get_memory(self):
+        # Current and peak memory in bytes since the last _reset_peak
+        if self._use_rss:
+            return get_rss("VmRSS"), get_rss("VmHWM")
+        return tracemalloc.get_traced_memory()
+
+    def _reset_peak(self):
+        if self._use_rss:
+            reset_peak_rss()
+        else:
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def step(self, name, inputs=(), attributes=None):
+        """Context manager recording a step.
+        Inputs are the frames the step reads, attributes are added to the event as they are.
+        """
+
+        if not self.enabled:
+            yield
+            return
+        current, peak = self._get_memory()
+        if self._stack:
+            self._stack[-1]["peak"] = max(self._stack[-1]["peak"], peak)
+        self._reset_peak()
+        args = dict(attributes or {})
+        if inputs:
+            args.update(_describe(max(inputs, key=len), "input"))
+        frame = {"memory": current, "peak": current, "args": args}
+        self._stack.append(frame)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall_end = time.perf_counter()
+            cpu_time = time.process_time() - cpu_start
+            _, peak = self._get_memory()
+            self._stack.pop()
+            frame["peak"] = max(frame["peak"], peak)
+            if self._stack:
+                self._stack[-1]["peak"] = max(self._stack[-1]["peak"], frame["peak"])
+            self._reset_peak()
+            args["cpu_ms"] = round(cpu_time * 1000, 3)
+            args["peak_memory_delta_mb"] = round(
+                (frame["peak"] - frame["memory"]) / 1024**2, 3
+            )
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": "pipeline",
+                    "ph": "X",
+                    "ts": round((wall_start - self._start) * 1e6, 1),
+                    "dur": round((wall_end - wall_start) * 1e6, 1),
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": args,
+                }
+            )
+
+    def set_output(self, output):
+        """Records the output of the current step."""
+
+        if self.enabled and self._stack:
+            self._stack[-1]["args"].update(_describe(output, "output"))
+
+    def save(self, path):
+        """Saves the events as a Chrome trace JSON file."""
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+    def get_summary(self):
+        """Returns a table of the recorded steps aggregated by name in the order they started.
+        Times are summed over the calls of a step, memory and shapes are the maximum of the calls.
+        """
+
+        if not self.events:
+            return pd.DataFrame()
+        events = pd.DataFrame(
+            [
+                {"step": event["name"], "wall_ms": event["dur"] / 1000, **event["args"]}
+                for event in sorted(self.events, key=lambda event: event["ts"])
+            ]
+        )
+        aggregations = {"calls": ("wall_ms", "size")}
+        for col in events.columns.drop("step"):
+            if col in ["wall_ms", "cpu_ms"]:
+                aggregations[col] = (col, "sum")
+            elif col != "end_block_num":
+                aggregations[col] = (col, "max")
+        return events.groupby("step", sort=False).agg(**aggregations).reset_index()
+
+
+def reset_peak_rss():
+    """Resets the peak resident set size of the process, returns False where Linux does not support it."""
+
+    # Linux resets the peak resident set size of the process on writing 5 to clear_refs
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def get_rss(field):
+    """Returns the current (VmRSS) or peak (VmHWM) resident set size of the process in bytes.
+    Without /proc the peak is taken from getrusage, None when it is not available.
+    """
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if field == "VmHWM":
+        try:
+            import resource
+        except ImportError:
+            return None
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return None
+
+
+def _describe(data, prefix):
+    # Shape and memory usage of a frame or of the largest frame of a tuple
+    if isinstance(data, tuple):
+        frames = [item for item in data if isinstance(item, (pd.DataFrame, pd.Series))]
+        data = max(frames, key=len) if frames else None
+    if isinstance(data, pd.Series):
+        data = data.to_frame()
+    if not isinstance(data, pd.DataFrame):
+        return {}
+    return {
+        f"{prefix}_rows": data.shape[0],
+        f"{prefix}_columns": data.shape[1],
+        f"{prefix}_memory_mb": round(data.memory_usage().sum() / 1024**2, 3),
+    }
+
+
+# Tracer shared by the pipeline, disabled unless a stage is run with --trace
+tracer = Tracer()
+
+
+def traced(func):
+    """Decorator recording a function or method as a step of the shared tracer."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not tracer.enabled:
+            return func(*args, **kwargs)
+        inputs = [arg for arg in args if isinstance(arg, (pd.DataFrame, pd.Series))]
+        with tracer.step(func.__qualname__, inputs):
+            result = func(*args, **kwargs)
+            tracer.set_output(result)
+        return result
+
+    return wrapper
+
+
+def save_trace(path):
+    """Saves the shared tracer to path and prints the summary table."""
+
+    tracer.save(path)
+    summary = tracer.get_summary()
+    if not summary.empty:
+        print(summary.to_string(index=False))
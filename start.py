@@ -12,6 +12,7 @@ if __name__ == "__main__":
         sales_train_path=config.sales_train_path,
         test_path=config.test_path,
         prepared_data_path=config.prepared_data_path,
+        category_encodings_path=config.category_encodings_path,
         replace_dict=config.replace_dict,
         max_time_cnt=config.max_time_cnt,
         max_time_price=config.max_time_price,
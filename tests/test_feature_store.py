@@ -0,0 +1,125 @@
+import timeit
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.category_encoder import CategoryEncoder
+from src.features.feature_store import FeatureStore, _get_keys
+
+MAX_ID = 2**31 - 1
+
+
+@pytest.fixture
+def features():
+    # Features of a window: two shops of city 0 and one of city 1, items of two categories
+    X = pd.DataFrame(
+        {
+            "shop_id": np.array([0, 0, 1, MAX_ID], dtype=np.int32),
+            "item_id": np.array([5, MAX_ID, 5, 0], dtype=np.int32),
+            "shop_name": np.array([0, 0, 0, 1], dtype=np.int8),
+            "item_category_id": np.array([2, 3, 2, 3], dtype=np.int8),
+            "item_category_name": np.array([1, 1, 1, 1], dtype=np.int8),
+            "cat_price_cat": np.array([0, 1, 0, 1], dtype=np.int8),
+            "item_cnt_lag_1": np.array([1.0, 2.0, 3.0, 4.0], dtype=np.float32),
+            "months_since_last_sale": np.array([1, 2, 1, 3], dtype=np.int8),
+            "months_since_first_sale": np.array([4, 2, 5, 3], dtype=np.int8),
+            "year": np.array([2015] * 4, dtype=np.int16),
+            "season": np.array([3] * 4, dtype=np.int8),
+            "month": np.array([10] * 4, dtype=np.int8),
+        }
+    )
+    for i, name in enumerate(FeatureStore.group_features):
+        X[name] = np.arange(4, dtype=np.float32) + 10 * i
+    return X
+
+
+def test_get_keys_at_id_limits():
+    ids = np.array([-1, 0, 1, MAX_ID])
+    first, second = (col.ravel() for col in np.meshgrid(ids, ids))
+    keys = _get_keys(first, second)
+
+    # The shop id 2**31 - 1 reaches the sign bit, the halves are read unsigned
+    assert len(np.unique(keys)) == len(keys)
+    halves = keys.view(np.uint64)
+    np.testing.assert_array_equal(halves >> np.uint64(32), first + 1)
+    np.testing.assert_array_equal(halves & np.uint64(0xFFFFFFFF), second + 1)
+
+
+def test_get_features_of_stored_pairs(features):
+    store = FeatureStore.from_features(features)
+    pairs = [(MAX_ID, 0), (0, MAX_ID), (0, 5)]
+
+    result = store.get_features(pairs)
+
+    expected = features.iloc[[3, 1, 0]].reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_get_features_of_unseen_pair(features):
+    store = FeatureStore.from_features(features)
+
+    # Shop 1 and item MAX_ID are known, the pair is not
+    result = store.get_features(pd.DataFrame({"shop_id": [1], "item_id": [MAX_ID]}))
+
+    row = result.iloc[0]
+    assert row["shop_name"] == 0
+    assert row["item_category_id"] == 3
+    assert row["cat_price_cat"] == 1
+    assert row["item_cnt_lag_1"] == 0
+    assert row["months_since_last_sale"] == -1
+    assert row["months_since_first_sale"] == -1
+    assert row["month"] == 10
+    # City 0 and category 3 are the group of the row of (0, MAX_ID)
+    assert (
+        row["sity_category_id_cnt_mean"] == features.loc[1, "sity_category_id_cnt_mean"]
+    )
+    # Shop 1 and item MAX_ID were never sold together
+    assert row["shop_item_cnt_mean"] == 0
+
+
+def test_get_features_of_unknown_ids(features):
+    store = FeatureStore.from_features(features)
+
+    result = store.get_features([(7, 8), (0, 5)])
+
+    assert result.loc[0, "shop_name"] == CategoryEncoder.unknown_code
+    assert result.loc[0, "item_category_id"] == CategoryEncoder.unknown_code
+    assert result.loc[0, "sity_item_category"] == 0
+    pd.testing.assert_series_equal(result.iloc[1], features.iloc[0], check_names=False)
+
+
+def test_save_load(features, tmp_path):
+    store = FeatureStore.from_features(features)
+    store.save(tmp_path / "store")
+
+    loaded = FeatureStore.load(tmp_path / "store")
+
+    pairs = [(1, MAX_ID), (MAX_ID, 0), (7, 8)]
+    pd.testing.assert_frame_equal(loaded.get_features(pairs), store.get_features(pairs))
+
+
+def test_get_feature_arrays(features):
+    store = FeatureStore.from_features(features)
+
+    arrays = store.get_feature_arrays([0, 1, 7], [MAX_ID, MAX_ID, 8])
+
+    expected = store.get_features([(0, MAX_ID), (1, MAX_ID), (7, 8)])
+    pd.testing.assert_frame_equal(pd.DataFrame(arrays), expected)
+
+
+def test_single_pair_latency(features):
+    # 100000 pairs, the latency of a stored and of an unseen pair is the best of many calls
+    X = features.loc[np.repeat(features.index, 25_000)].reset_index(drop=True)
+    X["shop_id"] = np.arange(len(X), dtype=np.int32)
+    store = FeatureStore.from_features(X)
+
+    for shop_id, item_id in [(10, 5), (10, 6)]:
+        seconds = min(
+            timeit.repeat(
+                lambda: store.get_feature_arrays(shop_id, item_id),
+                number=100,
+                repeat=5,
+            )
+        )
+        assert seconds / 100 < 1e-3
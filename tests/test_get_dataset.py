@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.get_dataset import ELT
+from utils import load_data
+
+
+@pytest.fixture
+def raw_dir(tmp_path):
+    # 3 shops of 2 cities and 6 items of 2 categories, months 0 to 2 of sales
+    rng = np.random.default_rng(0)
+    pd.DataFrame(
+        {"item_category_name": ["Игры - PS3", "Кино - DVD"], "item_category_id": [0, 1]}
+    ).to_csv(tmp_path / "item_categories.csv", index=False)
+    pd.DataFrame(
+        {
+            "item_name": [f"item {i}" for i in range(6)],
+            "item_id": range(6),
+            "item_category_id": [0, 0, 0, 1, 1, 1],
+        }
+    ).to_csv(tmp_path / "items.csv", index=False)
+    pd.DataFrame(
+        {"shop_name": ["Москва ТЦ 1", "Москва ТЦ 2", "Казань ТЦ"], "shop_id": [2, 3, 4]}
+    ).to_csv(tmp_path / "shops.csv", index=False)
+    pd.DataFrame({"ID": range(3), "shop_id": [2, 3, 4], "item_id": [0, 1, 2]}).to_csv(
+        tmp_path / "test.csv", index=False
+    )
+    n_rows = 300
+    sales = pd.DataFrame(
+        {
+            "date": "01.01.2013",
+            "date_block_num": rng.integers(0, 4, n_rows),
+            "shop_id": rng.integers(2, 5, n_rows),
+            "item_id": rng.integers(0, 6, n_rows),
+            "item_price": rng.uniform(90, 110, n_rows).round(2),
+            "item_cnt_day": rng.integers(1, 4, n_rows).astype(float),
+        }
+    )
+    new_month = sales["date_block_num"] == 3
+    # The item with the maximum price is removed from every month
+    sales.loc[np.flatnonzero(~new_month)[0], ["item_id", "item_price"]] = [5, 1000.0]
+    sales[~new_month].to_csv(tmp_path / "sales_train.csv", index=False)
+    sales[new_month].to_csv(tmp_path / "sales_new.csv", index=False)
+    return tmp_path
+
+
+def get_elt(raw_dir, sales_file):
+    return ELT(
+        str(raw_dir / "item_categories.csv"),
+        str(raw_dir / "items.csv"),
+        str(raw_dir / "shops.csv"),
+        str(raw_dir / sales_file),
+        str(raw_dir / "test.csv"),
+        str(raw_dir / "prepared_data.parquet"),
+        str(raw_dir / "encodings.json"),
+        state_dir=str(raw_dir / "state"),
+    )
+
+
+def test_refresh_twice_adds_the_month_once(raw_dir):
+    get_elt(raw_dir, "sales_train.csv").transform()
+    elt = get_elt(raw_dir, "sales_new.csv")
+    elt.refresh()
+    refreshed = load_data(elt.prepared_data_path)
+
+    with pytest.warns(UserWarning, match="Skipped"):
+        elt.refresh()
+
+    pd.testing.assert_frame_equal(load_data(elt.prepared_data_path), refreshed)
+    assert refreshed["date_block_num"].max() == 4
+    new_month = refreshed[refreshed["date_block_num"] == 3]
+    sales = pd.read_csv(raw_dir / "sales_new.csv")
+    expected = sales.loc[sales["item_id"] != 5, "item_cnt_day"].sum()
+    assert new_month["item_cnt"].sum() == expected
@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.category_encoder import CategoryEncoder
+from src.features.build_features import FeatureEngineering
+from src.features.rollup_cube import RollupCube
+from src.features.sales_cube import SalesCube
+
+
+@pytest.fixture
+def prepared_data():
+    # 6 shops in 3 cities and 40 items in 8 categories of 4 category names, the
+    # cells with sales are sampled so that groups have months without sales
+    rng = np.random.default_rng(0)
+    n_shops, n_items, n_blocks = 6, 40, 16
+    cells = rng.choice(n_shops * n_items * n_blocks, size=1500, replace=False)
+    shop_id, rest = np.divmod(cells, n_items * n_blocks)
+    item_id, date_block_num = np.divmod(rest, n_blocks)
+    item_category_id = item_id % 8
+    # Category 7 has no price, its price bin is missing
+    item_price = np.where(
+        item_category_id == 7, 0.0, rng.uniform(50, 3000, len(cells)).round(2)
+    )
+    return pd.DataFrame(
+        {
+            "shop_id": shop_id.astype("int16"),
+            "item_category_id": item_category_id.astype("int16"),
+            "item_id": item_id.astype("int32"),
+            "item_category_name": (item_category_id // 2).astype("int16"),
+            "shop_name": (shop_id // 2).astype("int16"),
+            "date_block_num": date_block_num.astype("int16"),
+            "item_cnt": rng.integers(-2, 30, len(cells)).astype("float32"),
+            "item_price": item_price.astype("float32"),
+        }
+    )
+
+
+def test_query_matches_groupby(prepared_data):
+    rollup = RollupCube(SalesCube.from_data(prepared_data))
+    result = rollup.query(["shop_name", "item_category_name"], 4, 10)
+
+    sales = prepared_data[
+        prepared_data["date_block_num"].between(4, 9) & (prepared_data["item_cnt"] != 0)
+    ]
+    expected = sales.groupby(["shop_name", "item_category_name", "date_block_num"])[
+        "item_cnt"
+    ].agg(["sum", "count"])
+    result = result.set_index(["shop_name", "item_category_name", "date_block_num"])
+    # Groups without sales in a month have a zero count and no mean
+    assert result["mean"].isna().equals(result["count"] == 0)
+    result = result[result["count"] > 0]
+    np.testing.assert_allclose(result["sum"], expected["sum"])
+    np.testing.assert_array_equal(result["count"], expected["count"])
+
+
+def test_query_drill_down(prepared_data):
+    rollup = RollupCube(SalesCube.from_data(prepared_data), clip_threshold=20)
+    city = rollup.query([], 0, 16, shop_name=1)
+    shops = rollup.query(["shop_id"], 0, 16, shop_name=1)
+
+    # The shops of city 1 are the shops 2 and 3, their sums add up to the city
+    assert sorted(shops["shop_id"].unique()) == [2, 3]
+    by_month = shops.groupby("date_block_num")[["sum", "count"]].sum()
+    np.testing.assert_allclose(city["sum"], by_month["sum"])
+    np.testing.assert_array_equal(city["count"], by_month["count"])
+    # The item count is clipped to [0, clip_threshold] as the lags are
+    assert shops["sum"].min() >= 0
+    assert (shops["mean"].dropna() <= 20).all()
+
+
+def test_query_price_bins(prepared_data):
+    rollup = RollupCube(SalesCube.from_data(prepared_data))
+    category_bins = pd.Series([1, 1, 2, 2, 3, 3, 4], index=range(7))
+    result = rollup.query(["cat_price_cat"], 0, 16, category_bins=category_bins)
+    categories = rollup.query(["item_category_id"], 0, 16)
+
+    # Categories are rolled up to their bins, category 7 has no bin and is left out
+    categories["cat_price_cat"] = categories["item_category_id"].map(category_bins)
+    expected = (
+        categories.dropna(subset=["cat_price_cat"])
+        .groupby(["cat_price_cat", "date_block_num"])[["sum", "count"]]
+        .sum()
+    )
+    np.testing.assert_allclose(result["sum"], expected["sum"])
+    np.testing.assert_array_equal(result["count"], expected["count"])
+    with pytest.raises(ValueError):
+        rollup.query(["cat_price_cat"], 0, 16)
+
+
+def test_query_unknown_key(prepared_data):
+    rollup = RollupCube(SalesCube.from_data(prepared_data))
+    with pytest.raises(ValueError):
+        rollup.query(["item_name"])
+
+
+@pytest.mark.parametrize("end_block_num", [12, 15])
+def test_use_rollup_matches_groupby(prepared_data, end_block_num):
+    cube = SalesCube.from_data(prepared_data)
+    encoder = CategoryEncoder({"cat_price_cat": CategoryEncoder.price_cat_labels})
+    features = [
+        FeatureEngineering(
+            end_block_num - 12, end_block_num, encoder, use_rollup=use_rollup
+        ).get_features(cube)
+        for use_rollup in [True, False]
+    ]
+    pd.testing.assert_frame_equal(features[0], features[1])
+
+
+def test_query_filters_match_groupby(prepared_data):
+    rollup = RollupCube(SalesCube.from_data(prepared_data))
+    result = rollup.query(["shop_id"], 3, 9, item_category_name=[0, 2], shop_name=1)
+
+    sales = prepared_data[
+        prepared_data["date_block_num"].between(3, 8)
+        & prepared_data["item_category_name"].isin([0, 2])
+        & (prepared_data["shop_name"] == 1)
+        & (prepared_data["item_cnt"] != 0)
+    ]
+    expected = sales.groupby(["shop_id", "date_block_num"])["item_cnt"].agg(
+        ["sum", "count"]
+    )
+    result = result.set_index(["shop_id", "date_block_num"])
+    result = result[result["count"] > 0]
+    np.testing.assert_allclose(result["sum"], expected["sum"])
+    np.testing.assert_array_equal(result["count"], expected["count"])
+    # A filter on a key of the query keeps its groups only
+    shops = rollup.query(["shop_name", "shop_id"], 3, 9, shop_name=[0, 2])
+    assert sorted(shops["shop_id"].unique()) == [0, 1, 4, 5]
+
+
+def test_query_item_price(prepared_data):
+    rollup = RollupCube(SalesCube.from_data(prepared_data))
+    result = rollup.query(["item_category_id"], 0, 16, measure="item_price")
+
+    # Prices are counted over the cells with a price, category 7 has none
+    priced = prepared_data[prepared_data["item_price"] != 0]
+    expected = (
+        priced.astype({"item_price": float})
+        .groupby(["item_category_id", "date_block_num"])["item_price"]
+        .agg(["sum", "count", "mean"])
+    )
+    result = result.set_index(["item_category_id", "date_block_num"])
+    assert (result.loc[7, "count"] == 0).all()
+    result = result[result["count"] > 0]
+    np.testing.assert_allclose(result["sum"], expected["sum"], rtol=1e-6)
+    np.testing.assert_array_equal(result["count"], expected["count"])
+    np.testing.assert_allclose(result["mean"], expected["mean"], rtol=1e-6)
+    with pytest.raises(ValueError):
+        rollup.query(["item_category_id"], measure="item_name")
+
+
+def test_query_month_range(prepared_data):
+    rollup = RollupCube(SalesCube.from_data(prepared_data))
+    everything = rollup.query(["shop_name", "item_category_id"])
+    result = rollup.query(["shop_name", "item_category_id"], 5, 11)
+
+    assert sorted(result["date_block_num"].unique()) == list(range(5, 11))
+    expected = everything[everything["date_block_num"].between(5, 10)]
+    pd.testing.assert_frame_equal(result, expected.reset_index(drop=True))
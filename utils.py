@@ -1,5 +1,13 @@
+import json
+import os
+import warnings
+
+import numpy as np
 import pandas as pd
 
+from src.data.schema import DATASET_DTYPES, LABEL_DTYPE, get_dtype, get_dtypes
+
+
 def get_data(data):
     """Extracts features and labels from the given dataset.
 
@@ -21,10 +29,58 @@ def get_data(data):
         )
     }
     X_train.rename(columns=rename_dict, inplace=True)
-    X_train = X_train.round().astype(int)
+    # Features planned as floats keep their decimals, the others are rounded
+    rounded_columns = [
+        col
+        for col in X_train.columns
+        if not np.issubdtype(get_dtype(col, DATASET_DTYPES) or "int64", np.floating)
+    ]
+    X_train[rounded_columns] = X_train[rounded_columns].round()
+    X_train = apply_dtypes(X_train, DATASET_DTYPES)
+    y_train = y_train.astype(LABEL_DTYPE)
     y_train.columns = ["y"]
     return X_train, y_train
 
+
+def apply_dtypes(df, plan):
+    """Casts the columns of a DataFrame to the dtypes of a plan from src.data.schema.
+
+    Columns already in their planned dtype are not copied and text columns are
+    kept. Integer dtypes are checked against the range of the values, numeric
+    columns that the plan does not cover or whose values do not fit are left
+    to downcast.
+
+    Args:
+        df (DataFrame): The dataset to cast, modified in place.
+        plan (dict): The dtype plan of the columns.
+
+    Returns:
+        DataFrame: The dataset with the planned dtypes.
+    """
+    fallback_columns = []
+    for col in df.columns:
+        dtype = get_dtype(col, plan)
+        values = df[col]
+        if values.dtype == dtype or not pd.api.types.is_numeric_dtype(values):
+            continue
+        if dtype is None:
+            fallback_columns.append(col)
+        elif np.issubdtype(dtype, np.integer) and (
+            values.hasnans
+            or values.min() < np.iinfo(dtype).min
+            or values.max() > np.iinfo(dtype).max
+        ):
+            warnings.warn(f"Values of {col} do not fit {dtype}, downcasting instead")
+            fallback_columns.append(col)
+        else:
+            df[col] = values.astype(dtype)
+    if fallback_columns:
+        fallback = downcast(df[fallback_columns].copy())
+        for col in fallback_columns:
+            df[col] = fallback[col]
+    return df
+
+
 def downcast(df, verbose=False):
     if not isinstance(df, pd.DataFrame):
         return df  # Skip if not a DataFrame
@@ -43,3 +99,108 @@ def downcast(df, verbose=False):
     if verbose:
         print("{:.1f}% compressed".format(100 * (start_mem - end_mem) / start_mem))
     return df
+
+
+def save_data(data, path):
+    """Saves a dataset in the format given by the extension of the path.
+
+    Supported formats are .csv, .parquet, .feather and .npy. A .npy path is a
+    directory with one .npy file per column and a manifest.json with the column
+    names and dtypes, which load_data memory-maps. Text columns are stored as
+    integer codes and their categories, so no file needs pickling.
+
+    Args:
+        data (DataFrame or Series): The dataset to save.
+        path (str): The output path.
+    """
+    if isinstance(data, pd.Series):
+        data = data.to_frame()
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    if path.endswith(".csv"):
+        data.to_csv(path, index=False)
+        return
+    # Binary formats require string column names
+    data = data.set_axis([str(col) for col in data.columns], axis=1)
+    if path.endswith(".parquet"):
+        data.to_parquet(path, index=False)
+    elif path.endswith(".feather"):
+        data.reset_index(drop=True).to_feather(path)
+    elif path.endswith(".npy"):
+        os.makedirs(path, exist_ok=True)
+        manifest = {"columns": [], "dtypes": [], "files": [], "categories": {}}
+        for i, col in enumerate(data.columns):
+            values = data[col]
+            if values.dtype == object:
+                file_name = f"{i}.codes.npy"
+                codes, categories = pd.factorize(values)
+                np.save(os.path.join(path, file_name), codes.astype(np.int32))
+                manifest["categories"][file_name] = f"{i}.categories.npy"
+                np.save(
+                    os.path.join(path, manifest["categories"][file_name]),
+                    categories.to_numpy(dtype=str),
+                )
+            else:
+                file_name = f"{i}.npy"
+                np.save(os.path.join(path, file_name), values.to_numpy())
+            manifest["columns"].append(col)
+            manifest["dtypes"].append(data[col].dtype.name)
+            manifest["files"].append(file_name)
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+    else:
+        raise ValueError(f"Unsupported data format: {path}")
+
+
+def load_data(path, plan=None, **kwargs):
+    """Loads a dataset saved by save_data.
+
+    Binary formats keep the dtypes they were saved with, .npy columns are
+    memory-mapped without copying, except the text ones. CSV columns are parsed directly into the
+    dtypes of the plan, integer ones at full width and then checked against the range of their
+    dtype, binary columns saved with other dtypes are cast.
+
+    Args:
+        path (str): The path of the dataset.
+        plan (dict): The dtype plan of the columns from src.data.schema.
+        **kwargs: Other arguments of read_csv, such as usecols or chunksize.
+
+    Returns:
+        DataFrame: The loaded dataset, an iterator of chunks with chunksize.
+    """
+    if path.endswith(".csv"):
+        if plan is None:
+            return pd.read_csv(path, **kwargs)
+        columns = pd.read_csv(path, nrows=0).columns
+        # read_csv wraps the values that overflow an integer dtype, so integer
+        # columns are parsed as int64 and narrowed by apply_dtypes, which checks
+        # their range and falls back to downcast
+        kwargs["dtype"] = {
+            col: "int64" if np.issubdtype(dtype, np.integer) else dtype
+            for col, dtype in get_dtypes(columns, plan).items()
+        }
+        data = pd.read_csv(path, **kwargs)
+        if kwargs.get("chunksize") is not None:
+            return (apply_dtypes(chunk, plan) for chunk in data)
+        return apply_dtypes(data, plan)
+    if path.endswith(".parquet"):
+        data = pd.read_parquet(path)
+    elif path.endswith(".feather"):
+        data = pd.read_feather(path)
+    elif path.endswith(".npy"):
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        columns = {}
+        for col, file_name in zip(manifest["columns"], manifest["files"]):
+            values = np.load(os.path.join(path, file_name), mmap_mode="r")
+            categories_file = manifest.get("categories", {}).get(file_name)
+            if categories_file is not None:
+                # Missing values have the code -1, the last category is NaN
+                categories = np.load(os.path.join(path, categories_file))
+                values = np.append(categories.astype(object), np.nan)[values]
+            columns[col] = values
+        data = pd.DataFrame(columns, copy=False)
+    else:
+        raise ValueError(f"Unsupported data format: {path}")
+    return data if plan is None else apply_dtypes(data, plan)